@@ -1,15 +1,15 @@
 from __future__ import annotations
 
 import base64
-import os
-import uuid
-from typing import Optional
+import binascii
+from typing import Optional, List, Tuple
 
-import aiofiles
 from pydantic import BaseModel
 
 from models.response import AsyncResponse
 from utilities import nsfw_predict
+from utilities.nsfw_batcher import NSFWBatcher, NSFWUnavailable, NSFWQueueFull, NSFWNotReady, NSFWLoadFailed
+from utilities.nsfw_cache import NSFWCache
 
 
 class NSFWPayload(BaseModel):
@@ -17,30 +17,36 @@ class NSFWPayload(BaseModel):
 
 
 class NSFWResponse(AsyncResponse):
-    MODEL = nsfw_predict.load_model('./resources/nsfw_model.h5')
+    __slots__ = ("nsfw_payload", "batcher", "cache", "retry_after")
 
-    def __init__(self, nsfw_payload: NSFWPayload):
+    def __init__(self, nsfw_payload: NSFWPayload, batcher: Optional[NSFWBatcher], cache: Optional[NSFWCache]):
         super().__init__()
         self.nsfw_payload: NSFWPayload = nsfw_payload
+        self.batcher: Optional[NSFWBatcher] = batcher
+        self.cache: Optional[NSFWCache] = cache
+
+        # Seconds the client should wait before retrying, only set while unavailable for a transient reason
+        self.retry_after: Optional[int] = None
 
     @classmethod
-    async def save_image(cls, payload: bytes, file_name: str = f"./resources/nsfw_images/{uuid.uuid4()}.jpg") -> Optional[str]:
+    def decode_image(cls, payload: bytes) -> Optional[bytes]:
         try:
-            async with aiofiles.open(file_name, mode="wb") as file:
-                await file.write(base64.decodebytes(payload))
-                await file.close()
+            image_bytes: bytes = base64.decodebytes(payload)
 
-        except:
+        except (binascii.Error, ValueError):
             return None
 
-        return file_name
+        return image_bytes or None
 
     @classmethod
-    def classify_model(cls, model, image_path):
-        results: Optional[dict] = None
+    async def classify_model(cls, batcher: NSFWBatcher, image_bytes: bytes) -> Optional[Tuple[List[float], bool]]:
+        results: Optional[Tuple[List[float], bool]] = None
 
         try:
-            results = nsfw_predict.classify(model, image_path)
+            results = await batcher.classify(image_bytes)
+
+        except NSFWUnavailable:
+            raise
 
         except:
             pass
@@ -48,44 +54,56 @@ class NSFWResponse(AsyncResponse):
         return results
 
     @classmethod
-    def remove_image(cls, image_path):
-        try:
-            os.remove(image_path)
+    def build_results(cls, percentages: List[float], nsfw: bool) -> dict:
+        data: dict = dict(zip(nsfw_predict.CATEGORIES, percentages))
+        data['is_nsfw'] = bool(nsfw)
+        return {'data': data}
 
-        except:
-            pass
+    async def complete(self) -> NSFWResponse:
+        # Classification disabled on this worker
+        if self.batcher is None:
+            self._status, self._message = 503, "Image classification is not available on this server"
+            return self
 
-    @classmethod
-    def is_nsfw(cls, results: dict):
-        data = results['data']
+        image_bytes: Optional[bytes] = self.decode_image(self.nsfw_payload.base64)
 
-        if data['neutral'] >= 45:
-            nsfw = False
+        # Failed to do it
+        if not image_bytes:
+            self._status, self._message = 400, "The photo you submitted was unable to be read by the system (did you supply an image?)"
+            return self
 
-        elif (data['sexy'] + data['porn'] + data['hentai']) >= 70:
-            nsfw = True
+        # Identical images are only ever classified once
+        digest: str = self.cache.digest(image_bytes)
+        cached: Optional[List[float]] = await self.cache.get(digest)
 
-        else:
-            nsfw = False
+        if cached is not None:
+            nsfw: bool = bool(self.batcher.policy.evaluate(cached)[0])
+            self._payload, self._status, self._message = self.build_results(cached, nsfw), 200, "Successfully classified the requested image"
+            return self
 
-        results['data']['is_nsfw'] = nsfw
-        return results
+        try:
+            results: Optional[Tuple[List[float], bool]] = await self.classify_model(self.batcher, image_bytes)
 
-    async def complete(self) -> NSFWResponse:
-        image_path: str = await self.save_image(self.nsfw_payload.base64)
+        except NSFWLoadFailed:
+            self._status, self._message = 503, "The classifier failed to load on this server"
+            return self
 
-        # Failed to do it
-        if not image_path:
-            self._status, self._message = 400, "The photo you submitted was unable to be read by the system (did you supply an image?)"
+        except NSFWNotReady:
+            self._status, self._message = 503, "The classifier is still starting up, please try again shortly"
+            self.retry_after = 5
             return self
 
-        results: Optional[dict] = self.classify_model(self.MODEL, image_path)
+        except NSFWQueueFull:
+            self._status, self._message = 503, "The classifier is currently overloaded, please try again shortly"
+            self.retry_after = 1
+            return self
 
         if not results:
             self._status, self._message = 500, "Failed to classify the requested image due to an error (perhaps an invalid image?)"
-            self.remove_image(image_path)
             return self
 
-        self._payload, self._status, self._message = self.is_nsfw(results), 200, "Successfully classified the requested image"
-        self.remove_image(image_path)
+        percentages, nsfw = results
+        await self.cache.set(digest, percentages)
+
+        self._payload, self._status, self._message = self.build_results(percentages, nsfw), 200, "Successfully classified the requested image"
         return self
@@ -1,42 +1,77 @@
 from __future__ import annotations
 
+import asyncio
+import ipaddress
 import json
-from typing import Optional, Dict, List
+import logging
+from typing import Optional, Dict, List, Union, Any, Callable, Awaitable
 
-import aiohttp
 import aiomysql
 import aioredis
+from pydantic import BaseModel
 
 from models.response import AsyncResponse
+from utilities.geoip import IPRangeDatabase
+from utilities.http import HTTPClient
+from utilities.lru import LRUCache
 from utilities.misc import hash_address
-from utilities.statistics.statistics import user_exists
+from utilities.statistics.statistics import user_exists, users_exist
 
 
 class GeolocateResponse(AsyncResponse):
     """
-    Using the https://geojs.io Open-Source IP Geolocation API
+    Using a local IP-range database when available, falling back to the https://geojs.io Open-Source IP Geolocation API
 
     """
 
+    __slots__ = ("ip", "mysql", "redis", "http", "geoip")
+
     LANGUAGES: Dict[str, List[str]] = json.loads(open("./resources/languages.json").read())
+    API_URL: str = "https://get.geojs.io/v1/ip/geo/{ip}.json"
+
+    # In-process tier in front of Redis, shared by every request in this worker
+    LOCAL_CACHE: LRUCache = LRUCache(max_size=8192, ttl=300)
+    INFLIGHT: Dict[str, asyncio.Task] = {}
+
+    # Negative cache marker & lifetime for addresses that failed to resolve
+    FAILED: object = object()
+    FAILED_EXPIRY: int = 60
 
-    def __init__(self, ip: str, redis: aioredis.Redis, mysql: aiomysql.Pool):
+    def __init__(self, ip: str, redis: aioredis.Redis, mysql: aiomysql.Pool, http: HTTPClient, geoip: Optional[IPRangeDatabase] = None):
         super().__init__()
         self.ip: str = ip
         self.mysql: aiomysql.Pool = mysql
         self.redis: aioredis.Redis = redis
+        self.http: HTTPClient = http
+        self.geoip: Optional[IPRangeDatabase] = geoip
+
+    @staticmethod
+    def is_address(value: str) -> bool:
+        """
+        Whether a value is a plain IPv4/IPv6 address, safe to put in the upstream URL & cache keys
+
+        """
 
-    @classmethod
-    async def request_ip(cls, ip: str):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"https://get.geojs.io/v1/ip/geo/{ip}.json") as request:
-                    return await request.json()
-        except:
-            return None
+            return getattr(ipaddress.ip_address(value), "scope_id", None) is None
+        except ValueError:
+            return False
+
+    async def request_ip(self, ip: str):
+        return await self.http.get_json(self.API_URL.format(ip=ip), timeout=5)
+
+    async def retrieve_cached(self, ip: str) -> Union[Dict, object, None]:
+        """
+        Look up the Redis cache
+
+        :return: The cached data, FAILED if the lookup recently failed, or None if not cached
+
+        """
+
+        result, failed = await self.redis.mget(f"chromegle:geolocate:{ip}", f"chromegle:geolocate:failed:{ip}")
 
-    async def retrieve_cached(self, ip: str) -> Optional[Dict]:
-        result = await self.redis.get(f"chromegle:geolocate:{ip}")
+        if failed is not None:
+            return self.FAILED
 
         # Not found
         if result is None:
@@ -47,33 +82,237 @@ class GeolocateResponse(AsyncResponse):
         except:
             return None
 
-    async def update_cached(self, ip: str, data: dict) -> None:
+    async def update_cached(self, ip: str, data: Optional[dict]) -> None:
         # Update cached data
-        if ip is not None and len(ip) > 0:
-            await self.redis.set(f"chromegle:geolocate:{ip}", json.dumps(data), ex=7200)
+        if ip is None or len(ip) < 1:
+            return
 
-    async def complete(self) -> GeolocateResponse:
-        # Retrieve from cache
-        response: Optional[Dict] = await self.retrieve_cached(self.ip)
+        # Definitive "no data" answers are remembered briefly so unresolvable addresses don't hit the API on every request
+        if data is None:
+            self.LOCAL_CACHE.set(ip, self.FAILED, ttl=self.FAILED_EXPIRY)
+            await self.redis.set(f"chromegle:geolocate:failed:{ip}", 1, ex=self.FAILED_EXPIRY)
+            return
 
-        # If not found in cache, get
-        if response is None:
-            response: Optional[Dict] = await self.request_ip(self.ip)
+        self.LOCAL_CACHE.set(ip, data)
+        await self.redis.set(f"chromegle:geolocate:{ip}", json.dumps(data), ex=7200)
+
+    async def resolve(self, ip: str) -> Optional[Dict]:
+        """
+        Resolve an address through Redis, then the upstream API
+
+        """
+
+        response: Union[Dict, object, None] = await self.retrieve_cached(ip)
+
+        if response is self.FAILED:
+            self.LOCAL_CACHE.set(ip, self.FAILED, ttl=self.FAILED_EXPIRY)
+            return None
+
+        if response is not None:
+            self.LOCAL_CACHE.set(ip, response)
+            return response
+
+        return await self.fetch(ip)
+
+    async def fetch(self, ip: str) -> Optional[Dict]:
+        """
+        Resolve an address through the upstream API, caching the outcome
+
+        """
+
+        try:
+            response: Optional[Dict] = await self.request_ip(ip)
+
+        # Transient (timeout, connection error, any non-2xx status), not remembered so the next lookup tries again
+        except Exception as ex:
+            logging.warning(f"Failed to geolocate {ip}: {ex!r}")
+            return None
+
+        # Upstream answered but has no location for the address, the only failure worth remembering
+        if type(response) != dict or not response.get("country_code"):
+            await self.update_cached(ip, None)
+            return None
+
+        # Get Language
+        lang: Optional[List[str]] = self.LANGUAGES.get(response.get("country_code"))
+        if lang is not None:
+            response["language"] = lang
+
+        await self.update_cached(ip, response)
+        return response
+
+    async def lookup(self, ip: str) -> Optional[Dict]:
+        """
+        Geolocate an address through the in-process cache, then the local database, then (sharing one resolution
+        between concurrent lookups) Redis & the upstream API
+
+        """
+
+        located: Any = self.lookup_local(ip)
+
+        if located is self.FAILED:
+            return None
+
+        if located is not None:
+            return located
+
+        return await self.coalesce(ip, self.resolve)
+
+    def lookup_local(self, ip: str) -> Union[Dict, object, None]:
+        """
+        Geolocate an address without leaving the process
+
+        :return: A copy of the data, FAILED if the lookup recently failed, or None if unknown locally
+
+        """
+
+        cached: Any = self.LOCAL_CACHE.get(ip)
+
+        if cached is self.FAILED:
+            return self.FAILED
+
+        if cached is not None:
+            return dict(cached)
+
+        # Local database answers in microseconds, no need to cache it
+        if self.geoip is not None:
+            return self.geoip.lookup(ip)
 
-            # Get Language
-            lang: Optional[List, str] = self.LANGUAGES.get(response.get("country_code"))
-            if lang is not None:
-                response["language"] = lang
+        return None
+
+    async def coalesce(self, ip: str, resolver: Callable[[str], Awaitable[Optional[Dict]]]) -> Optional[Dict]:
+        """
+        Share one resolution of an address between every concurrent caller in this worker
+
+        """
+
+        task: Optional[asyncio.Task] = self.INFLIGHT.get(ip)
+
+        if task is None:
+            task = self.INFLIGHT[ip] = asyncio.create_task(resolver(ip))
+            task.add_done_callback(lambda _: self.INFLIGHT.pop(ip, None))
+
+        response: Optional[Dict] = await asyncio.shield(task)
+        return None if response is None else dict(response)
+
+    async def complete(self) -> GeolocateResponse:
+        if not self.is_address(self.ip):
+            self._payload, self._status, self._message = self._payload, 400, f"{self.ip} is not a valid IP address"
+            return self
+
+        response: Optional[Dict] = await self.lookup(self.ip)
 
         # If not found
-        if not response or type(response) != dict:
+        if response is None:
             self._payload, self._status, self._message = self._payload, 500, f"Failed to grab geolocation data for {self.ip}"
             return self
 
         # Check if a Chromegler
         response["chromegler"] = await user_exists(hash_address(self.ip), self.mysql, self.redis, use_redis=True)
 
-        await self.update_cached(self.ip, response)
         self._payload, self._status, self._message = response, 200, f"Successfully retrieved geolocation data for {self.ip}"
+        return self
+
+
+class BulkGeolocatePayload(BaseModel):
+    addresses: List[str]
+
+
+class BulkGeolocateResponse(GeolocateResponse):
+    """
+    Geolocate many addresses at once, with one Redis round-trip for cache hits, one query for Chromegler membership
+    and concurrent upstream requests for the rest
+
+    """
+
+    __slots__ = ("requested", "addresses", "valid")
+
+    MAX_ADDRESSES: int = 100
+
+    def __init__(self, payload: BulkGeolocatePayload, redis: aioredis.Redis, mysql: aiomysql.Pool, http: HTTPClient, geoip: Optional[IPRangeDatabase] = None):
+        super().__init__("", redis, mysql, http, geoip)
+        self.requested: int = len(payload.addresses)
+
+        # Capped before de-duplicating, invalid addresses are answered with null and never leave the process
+        self.addresses: List[str] = list(dict.fromkeys(payload.addresses[:self.MAX_ADDRESSES]))
+        self.valid: List[str] = [address for address in self.addresses if self.is_address(address)]
+
+    async def retrieve_cached_many(self, ips: List[str]) -> Dict[str, Union[Dict, object, None]]:
+        """
+        Look up the Redis cache for many addresses with a single MGET
+
+        :return: The cached data, FAILED if the lookup recently failed, or None if not cached, per address
+
+        """
+
+        keys: List[str] = [key for ip in ips for key in (f"chromegle:geolocate:{ip}", f"chromegle:geolocate:failed:{ip}")]
+        values: List[Optional[bytes]] = await self.redis.mget(*keys)
+        cached: Dict[str, Union[Dict, object, None]] = {}
+
+        for ip, result, failed in zip(ips, values[0::2], values[1::2]):
+            if failed is not None:
+                self.LOCAL_CACHE.set(ip, self.FAILED, ttl=self.FAILED_EXPIRY)
+                cached[ip] = self.FAILED
+                continue
+
+            try:
+                cached[ip] = None if result is None else json.loads(result.decode('utf-8'))
+            except:
+                cached[ip] = None
+
+            if cached[ip] is not None:
+                self.LOCAL_CACHE.set(ip, cached[ip])
+
+        return cached
+
+    async def lookup_many(self, ips: List[str]) -> Dict[str, Optional[Dict]]:
+        results: Dict[str, Optional[Dict]] = {}
+        remote: List[str] = []
+
+        for ip in ips:
+            located: Any = self.lookup_local(ip)
+
+            if located is None:
+                remote.append(ip)
+            else:
+                results[ip] = None if located is self.FAILED else located
+
+        if not remote:
+            return results
+
+        misses: List[str] = []
+
+        for ip, cached in (await self.retrieve_cached_many(remote)).items():
+            if cached is None:
+                misses.append(ip)
+            else:
+                results[ip] = None if cached is self.FAILED else dict(cached)
+
+        fetched: List[Optional[Dict]] = await asyncio.gather(*(self.coalesce(ip, self.fetch) for ip in misses))
+        results.update(zip(misses, fetched))
+
+        return results
+
+    async def complete(self) -> BulkGeolocateResponse:
+        if not self.requested:
+            self._payload, self._status, self._message = self._payload, 400, "No addresses were provided"
+            return self
+
+        if self.requested > self.MAX_ADDRESSES:
+            self._payload, self._status, self._message = self._payload, 400, f"At most {self.MAX_ADDRESSES} addresses may be geolocated at once"
+            return self
+
+        results: Dict[str, Optional[Dict]] = await self.lookup_many(self.valid)
+
+        # Check which are Chromeglers
+        signatures: Dict[str, str] = {ip: hash_address(ip) for ip, result in results.items() if result is not None}
+        existence: Dict[str, bool] = await users_exist(list(signatures.values()), self.mysql, self.redis)
+
+        for ip, signature in signatures.items():
+            results[ip]["chromegler"] = existence.get(signature, False)
 
+        self._payload, self._status, self._message = (
+            {address: results.get(address) for address in self.addresses}, 200,
+            f"Successfully retrieved geolocation data for {len(signatures)} of {len(self.addresses)} addresses"
+        )
         return self
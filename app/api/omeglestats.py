@@ -2,32 +2,32 @@ from __future__ import annotations
 
 import random
 import string
-from typing import Union
-
-import aiohttp
+from typing import Optional
 
 from models.response import AsyncResponse
+from utilities.http import HTTPClient
 
 
 class StatResponse(AsyncResponse):
+    __slots__ = ("http",)
+
+    API_URL: str = "https://front38.omegle.com/status"
 
-    def __init__(self):
+    def __init__(self, http: HTTPClient):
         super().__init__()
+        self.http: HTTPClient = http
 
     @classmethod
     def __generate_request_url(cls):
         no_cache = random.randint(1000000000000000, 9999999999999999)
         rand_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=7))
-        return f"https://front38.omegle.com/status?nocache=0.{no_cache}&randid={rand_id}"
+        return f"{cls.API_URL}?nocache=0.{no_cache}&randid={rand_id}"
 
-    @classmethod
-    async def request_data(cls) -> Union[str, dict]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(cls.__generate_request_url()) as request:
-                try:
-                    return await request.json()
-                except:
-                    return await request.text()
+    async def request_data(self) -> Optional[dict]:
+        try:
+            return await self.http.get_json(self.__generate_request_url(), timeout=5)
+        except:
+            return None
 
     async def complete(self) -> StatResponse:
         response: dict = await self.request_data()
@@ -1,17 +1,56 @@
 from __future__ import annotations
 
 import base64
+import enum
+import hashlib
 import io
+import math
+from typing import Dict, List, Tuple, Optional
 
 import aioredis
 from PIL import Image, ImageDraw, ImageFont
 
 import config
 from models.response import AsyncResponse
+from utilities.lru import LRUCache
+
+
+class GlyphAtlas:
+    """
+    A set of characters rasterized once into a single sprite sheet, so text can be composed by blitting
+
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont, characters: str, colour: str):
+        self.boxes: Dict[str, Tuple[int, int, int, int]] = {}
+        self.advances: Dict[str, float] = {character: font.getlength(character) for character in characters}
+
+        height: int = max(font.getbbox(character)[3] for character in characters)
+        widths: List[int] = [max(font.getbbox(character)[2], math.ceil(self.advances[character])) for character in characters]
+
+        self.sheet: Image = Image.new("RGBA", (sum(widths), height))
+        draw: ImageDraw = ImageDraw.Draw(self.sheet)
+        x: int = 0
+
+        for character, width in zip(characters, widths):
+            draw.text((x, 0), character, font=font, fill=colour)
+            self.boxes[character] = (x, 0, x + width, height)
+            x += width
+
+    def width(self, text: str) -> float:
+        return sum(self.advances[character] for character in text)
+
+    def blit(self, image: Image, text: str, position: Tuple[float, float]) -> None:
+        x, y = position
+
+        for character in text:
+            image.alpha_composite(self.sheet, dest=(math.floor(x + 0.5), math.floor(y + 0.5)), source=self.boxes[character])
+            x += self.advances[character]
 
 
 class DynamicStatsImage:
     MARGIN, SPACE_BETWEEN = 0, 0
+    IMAGE_WIDTH, IMAGE_HEIGHT = 150, 57
 
     LARGE_FONT = ImageFont.truetype(config.Statistics.STATS_IMAGE_FONT_PATH, 30)
     SMALL_FONT = ImageFont.truetype(config.Statistics.STATS_IMAGE_FONT_PATH, 10)
@@ -24,49 +63,123 @@ class DynamicStatsImage:
 
     LARGE_FONT_HEIGHT = LARGE_FONT.size
 
+    # Everything an online count can contain, rendered once
+    ONLINE_COUNT_ATLAS: GlyphAtlas = GlyphAtlas(LARGE_FONT, "0123456789,+", LARGE_LABEL_COLOUR)
+
+    # The canvas with the fixed label already drawn, rendered once
+    BACKGROUND: Image = Image.new("RGBA", (IMAGE_WIDTH, IMAGE_HEIGHT))
+    ImageDraw.Draw(BACKGROUND).text(
+        ((IMAGE_WIDTH / 2 - ONLINE_COUNT_SMALL_LABEL_LENGTH / 2), MARGIN / 2 + LARGE_FONT_HEIGHT + 7),
+        ONLINE_COUNT_LABEL, font=SMALL_FONT, fill=SMALL_LABEL_COLOUR
+    )
+
     def __init__(self, online_count: str):
         self.online_count: str = online_count
 
     def generate(self) -> Image:
-        IMAGE_WIDTH, IMAGE_HEIGHT = 150, 57
-        image: Image = Image.new("RGBA", (IMAGE_WIDTH, IMAGE_HEIGHT))
-        draw: ImageDraw = ImageDraw.Draw(image)
-
-        draw.text(
-            ((IMAGE_WIDTH / 2 - self.LARGE_FONT.getsize(self.online_count)[0] / 2), self.MARGIN / 2 + 4),
-            self.online_count, font=self.LARGE_FONT, fill=self.LARGE_LABEL_COLOUR)
+        image: Image = self.BACKGROUND.copy()
 
-        draw.text(
-            ((IMAGE_WIDTH / 2 - self.ONLINE_COUNT_SMALL_LABEL_LENGTH / 2), self.MARGIN / 2 + self.LARGE_FONT_HEIGHT + 7),
-            self.ONLINE_COUNT_LABEL, font=self.SMALL_FONT, fill=self.SMALL_LABEL_COLOUR
+        self.ONLINE_COUNT_ATLAS.blit(
+            image, self.online_count,
+            ((self.IMAGE_WIDTH / 2 - self.ONLINE_COUNT_ATLAS.width(self.online_count) / 2), self.MARGIN / 2 + 4)
         )
 
         return image
 
 
+class ImageFormat(str, enum.Enum):
+    """
+    How the statistics image is included in the JSON statistics
+
+    """
+
+    INLINE = "inline"  # Base64 PNG
+    URL = "url"  # Where to fetch the PNG from
+    ETAG = "etag"  # The current ETag of that PNG, to revalidate a copy the client already has
+
+
 class StatsImageResponse(AsyncResponse):
+    __slots__ = ("stats_data", "redis")
+
+    # Finished (base64 PNG) images by online count, the count changes far less often than it's requested
+    RENDER_CACHE: LRUCache = LRUCache(max_size=256)
+
+    # Bumped whenever the design changes, so clients don't keep an old image for an unchanged count
+    VERSION: int = 1
+
+    IMAGE_KEY: str = "chromegle:stats:statistics-image"
+    ETAG_KEY: str = "chromegle:stats:statistics-image:etag"
 
     def __init__(self, stats_data: dict, redis: aioredis.Redis):
         super().__init__()
         self.stats_data: dict = stats_data
         self.redis: aioredis.Redis = redis
 
+    @property
+    def online_count(self) -> str:
+        return f"{self.stats_data['online_users']:,}+"
+
+    @classmethod
+    def etag(cls, online_count: str) -> str:
+        """
+        Strong ETag for the image of an online count, identical on every worker
+
+        """
+
+        return '"%s"' % hashlib.sha1(f"{cls.VERSION}:{online_count}".encode("utf-8")).hexdigest()[:20]
+
     async def __generate_image(self) -> bytes:
-        image: Image = DynamicStatsImage(f"{self.stats_data['online_users']:,}+").generate()
+        online_count: str = self.online_count
+        rendered: Optional[bytes] = self.RENDER_CACHE.get(online_count)
+
+        if rendered is None:
+            buffered = io.BytesIO()
+            DynamicStatsImage(online_count).generate().save(buffered, format="PNG")
+            rendered = base64.b64encode(buffered.getvalue())
+            self.RENDER_CACHE.set(online_count, rendered)
+
+        return rendered
+
+    async def update_image(self) -> str:
+        # Generate and enter into Redis Cache
+        image = await self.__generate_image()
 
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue())
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self.IMAGE_KEY, image, ex=config.Statistics.STATS_IMAGE_EXPIREY)
+            pipe.set(self.ETAG_KEY, self.etag(self.online_count), ex=config.Statistics.STATS_IMAGE_EXPIREY)
+            await pipe.execute()
+
+        return image.decode("utf-8")
 
     async def get_image(self) -> str:
         # Get from Redis Cache if available
-        image = await self.redis.get("chromegle:stats:statistics-image")
+        image = await self.redis.get(self.IMAGE_KEY)
         if image is not None:
             return image.decode("utf-8")
 
-        # Get and enter into Redis Cache
-        image = await self.__generate_image()
-        await self.redis.set("chromegle:stats:statistics-image", image, ex=config.Statistics.STATS_IMAGE_EXPIREY)
+        return await self.update_image()
+
+    async def get_etag(self) -> str:
+        etag = await self.redis.get(self.ETAG_KEY)
+        if etag is not None:
+            return etag.decode("utf-8")
+
+        await self.update_image()
+        return self.etag(self.online_count)
+
+    async def get_png(self) -> Tuple[bytes, str]:
+        """
+        Get the raw image & its ETag
+
+        """
+
+        image, etag = await self.redis.mget(self.IMAGE_KEY, self.ETAG_KEY)
+
+        # Either missing (or written before ETags were), regenerate both together
+        if image is None or etag is None:
+            image, etag = (await self.update_image()).encode("utf-8"), self.etag(self.online_count).encode("utf-8")
+
+        return base64.b64decode(image), etag.decode("utf-8")
 
     async def complete(self) -> StatsImageResponse:
         self._payload, self._status, self._message = await self.get_image(), 200, "Successfully retrieved Omegle's website stats as an image"
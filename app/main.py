@@ -13,24 +13,30 @@ from fastapi_limiter.depends import RateLimiter
 from starlette import status
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request, ClientDisconnect
-from starlette.responses import JSONResponse
+from starlette.responses import Response
 
 import config
 from api.classify_image import NSFWResponse, NSFWPayload
-from api.geolocate import GeolocateResponse
+from api.geolocate import GeolocateResponse, BulkGeolocateResponse, BulkGeolocatePayload
 from api.omeglestats import StatResponse
-from api.statsimage import StatsImageResponse
-from models.mysql import create_template
-from models.response import FilledResponse
-from utilities.misc import get_address
-from utilities.statistics.statistics import log_statistics, get_statistics, get_chrome_statistics, log_statistics_bulk
+from api.statsimage import StatsImageResponse, ImageFormat
+from models.mysql import migrate
+from models.response import FilledResponse, APIJSONResponse, RawJSON
+from utilities.cache import ResponseCache, CacheEntry, CachedResponse
+from utilities.geoip import IPRangeDatabase
+from utilities.http import HTTPClient
+from utilities.misc import get_address, conditional_response
+from utilities.nsfw_batcher import NSFWBatcher, create_executor
+from utilities.nsfw_cache import NSFWCache
+from utilities.nsfw_predict import NSFWPolicy
+from utilities.statistics.buffer import TrackingBuffer, ActivityBuffer
+from utilities.statistics.refresher import StatisticsRefresher
+from utilities.statistics.statistics_sql import StatisticSQL
+from utilities.statistics.statistics import log_statistics, get_statistics, get_statistics_entry, get_chrome_statistics_entry, log_statistics_bulk
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 
-# from api.classify_image import NSFWPayload, NSFWResponse
-
-
 # TODO rate limiting
 
 class ChromegleAPI(FastAPI):
@@ -44,6 +50,7 @@ class ChromegleAPI(FastAPI):
             "version": "1.0.0",
             "openapi_url": "/api-docs",
             "description": "Internal API for the Chromegle Chrome Extension",
+            "default_response_class": APIJSONResponse,
         }
         extra.update(new)
         return extra
@@ -63,6 +70,7 @@ class ChromegleAPI(FastAPI):
             allow_origins=self.origins,
             allow_methods=self.origins,
             allow_headers=self.origins,
+            expose_headers=["ETag", "Age"],
             allow_credentials=True
         )
 
@@ -72,6 +80,15 @@ class ChromegleAPI(FastAPI):
             self.loop: AbstractEventLoop = asyncio.get_event_loop()
 
         self.sql_pool: Optional[aiomysql.Pool] = None
+        self.http: Optional[HTTPClient] = None
+        self.geoip: Optional[IPRangeDatabase] = None
+        self.nsfw_batcher: Optional[NSFWBatcher] = None
+        self.nsfw_cache: Optional[NSFWCache] = None
+        self.tracking_buffer: Optional[TrackingBuffer] = None
+        self.activity_buffer: Optional[ActivityBuffer] = None
+        self.stats_refresher: Optional[StatisticsRefresher] = None
+        self.stats_responses: ResponseCache = ResponseCache()
+        self.chrome_stats_responses: ResponseCache = ResponseCache()
 
 
 app: ChromegleAPI = ChromegleAPI(
@@ -92,18 +109,89 @@ async def startup():
         db=config.MariaDB.DATABASE, loop=app.loop
     )
 
-    # Create Template
-    await create_template(app.sql_pool, file_path=config.MariaDB.SQL_TEMPLATE_PATH)
+    # Migrate Schema
+    await migrate(app.sql_pool, directory=config.MariaDB.MIGRATIONS_PATH)
+
+    # Create Stat Tracking Buffer
+    app.tracking_buffer = TrackingBuffer(app.sql_pool, interval=config.Statistics.TRACKING_FLUSH_INTERVAL)
+    await app.tracking_buffer.start()
+
+    # Create User Activity Buffer
+    app.activity_buffer = ActivityBuffer(app.sql_pool, interval=config.Statistics.ACTIVITY_FLUSH_INTERVAL)
+    await app.activity_buffer.start()
 
     # Create Redis
     app.redis = aioredis.Redis(host=app.redis_host, port=app.redis_port, password=app.redis_password)
     await FastAPILimiter.init(app.redis)
 
+    # Create HTTP Client
+    app.http = HTTPClient(
+        limit=config.HTTP.LIMIT,
+        limit_per_host=config.HTTP.LIMIT_PER_HOST,
+        dns_cache_ttl=config.HTTP.DNS_CACHE_TTL,
+        keepalive_timeout=config.HTTP.KEEPALIVE_TIMEOUT,
+        timeout=config.HTTP.TIMEOUT,
+        retries=config.HTTP.RETRIES
+    )
+    await app.http.start()
+
+    # Load Offline Geolocation Database (memory-mapped, shared between workers)
+    if config.Geolocation.DATABASE_PATH and os.path.exists(config.Geolocation.DATABASE_PATH):
+        app.geoip = IPRangeDatabase(config.Geolocation.DATABASE_PATH, languages=GeolocateResponse.LANGUAGES)
+
+    # Create Statistics Refresher (one leader in the fleet keeps the cached statistics warm)
+    app.stats_refresher = StatisticsRefresher(app.redis, app.sql_pool, app.http, interval=config.Statistics.REFRESH_INTERVAL)
+    await app.stats_refresher.start()
+
+    # Create NSFW Batcher (the model loads in the background, other endpoints serve immediately)
+    if config.Classification.ENABLED:
+        app.nsfw_batcher = NSFWBatcher(
+            config.Classification.MODEL_PATH,
+            create_executor(
+                config.Classification.EXECUTOR, config.Classification.EXECUTOR_WORKERS,
+                config.Classification.MODEL_PATH, config.Classification.BACKEND, config.Classification.BATCH_SIZE
+            ),
+            backend=config.Classification.BACKEND,
+            policy=NSFWPolicy(
+                neutral_threshold=config.Classification.NEUTRAL_THRESHOLD,
+                explicit_threshold=config.Classification.EXPLICIT_THRESHOLD
+            ),
+            max_workers=config.Classification.EXECUTOR_WORKERS,
+            max_batch_size=config.Classification.BATCH_SIZE,
+            max_delay_ms=config.Classification.BATCH_WINDOW_MS,
+            max_queue_size=config.Classification.MAX_QUEUE_SIZE
+        )
+        await app.nsfw_batcher.start()
+
+        # Create NSFW Result Cache
+        app.nsfw_cache = NSFWCache(app.redis, max_size=config.Classification.CACHE_SIZE, expiry=config.Classification.CACHE_EXPIRY)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.stats_refresher is not None:
+        await app.stats_refresher.stop()
+
+    if app.nsfw_batcher is not None:
+        await app.nsfw_batcher.stop()
+
+    if app.tracking_buffer is not None:
+        await app.tracking_buffer.stop()
+
+    if app.activity_buffer is not None:
+        await app.activity_buffer.stop()
+
+    # Per-statement timings for this worker's lifetime (only ever logged, never served)
+    StatisticSQL.log_timings()
+
+    if app.http is not None:
+        await app.http.close()
+
 
 @app.post("/chromegle/stats", tags=['Chromegle'], dependencies=[Depends(RateLimiter(times=50, seconds=10))])
 async def post_chromegle_stats(action: str, request: Request):
-    await log_statistics(signature=get_address(request), action=action, sql_pool=app.sql_pool)
-    return FilledResponse(status=200, message="Received Statistics").serialize()
+    await log_statistics(signature=get_address(request), action=action, tracking=app.tracking_buffer, activity=app.activity_buffer)
+    return FilledResponse(status=200, message="Received Statistics").to_response()
 
 
 @app.post("/chromegle/stats/bulk", tags=['Chromegle'], dependencies=[Depends(RateLimiter(times=5, seconds=10))])
@@ -111,7 +199,7 @@ async def post_chromegle_stats_bulk(request: Request):
     try:
         response: Union[dict, str] = await request.json()
     except ClientDisconnect:
-        return JSONResponse(
+        return APIJSONResponse(
             status_code=500,
             content={
                 "code": status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -123,49 +211,124 @@ async def post_chromegle_stats_bulk(request: Request):
 
     actions: List[List[str, int]] = response.get("stats", [])
 
-    await log_statistics_bulk(signature=get_address(request), actions=actions, sql_pool=app.sql_pool)
-    return FilledResponse(status=200, message="Received Statistics").serialize()
+    await log_statistics_bulk(signature=get_address(request), actions=actions, tracking=app.tracking_buffer, activity=app.activity_buffer)
+    return FilledResponse(status=200, message="Received Statistics").to_response()
 
 
-@app.get("/chromegle/stats", tags=['Chromegle'])
-async def get_chromegle_stats(request: Request):
-    stats: dict = await get_statistics(sql_pool=app.sql_pool, redis=app.redis, use_redis=True)
-    image: str = str((await StatsImageResponse(stats, app.redis).complete()).payload)
+@app.get("/chromegle/stats", tags=['Chromegle'], response_class=Response)
+async def get_chromegle_stats(request: Request, image: ImageFormat = ImageFormat.INLINE):
+    """
+    Identical for every client (see /chromegle/address for the caller's address), so it can be cached by a CDN
 
-    stats["image"] = image
-    stats["address"] = get_address(request, hashed=False)
+    """
 
-    return FilledResponse(
-        status=200,
-        message="Successfully retrieved statistics",
-        payload=stats
-    ).serialize()
+    entry: CacheEntry = await get_statistics_entry(sql_pool=app.sql_pool, redis=app.redis)
+    image_url: Optional[str] = str(request.url_for("get_chromegle_stats_image")) if image == ImageFormat.URL else None
+
+    async def render(stats_entry: CacheEntry) -> bytes:
+        stats: dict = json.loads(stats_entry.value.decode("utf-8"))
+
+        if image == ImageFormat.URL:
+            stats["image"] = image_url
+        elif image == ImageFormat.ETAG:
+            stats["image"] = await StatsImageResponse(stats, app.redis).get_etag()
+        else:
+            stats["image"] = str((await StatsImageResponse(stats, app.redis).complete()).payload)
+
+        return FilledResponse(
+            status=200,
+            message="Successfully retrieved statistics",
+            payload=stats
+        ).encode()
 
+    response: CachedResponse = await app.stats_responses.get(entry, render, variant=(image, image_url))
+    return conditional_response(request, response.body, "application/json", response.headers)
 
-@app.get("/chromegle/chrome/stats", tags=['Chromegle'])
-async def get_chromegle_chrome_webstore_stats():
-    stats: dict = await get_chrome_statistics(redis=app.redis, use_redis=True)
 
+@app.get("/chromegle/address", tags=['Chromegle'])
+async def get_chromegle_address(request: Request):
     return FilledResponse(
         status=200,
-        message="Successfully retrieved web-store statistics",
-        payload=stats
-    ).serialize()
+        message="Successfully retrieved address",
+        payload={"address": get_address(request, hashed=False)}
+    ).to_response(headers={"Cache-Control": "private, no-store"})
+
+
+@app.get("/chromegle/stats/image", tags=['Chromegle'], response_class=Response)
+async def get_chromegle_stats_image(request: Request):
+    stats: dict = await get_statistics(sql_pool=app.sql_pool, redis=app.redis, use_redis=True)
+    image, etag = await StatsImageResponse(stats, app.redis).get_png()
+
+    headers: Mapping[str, str] = {"ETag": etag, "Cache-Control": f"public, max-age={config.Statistics.REFRESH_INTERVAL}"}
+    return conditional_response(request, image, "image/png", headers)
+
+
+@app.get("/chromegle/chrome/stats", tags=['Chromegle'], response_class=Response)
+async def get_chromegle_chrome_webstore_stats(request: Request):
+    entry: CacheEntry = await get_chrome_statistics_entry(redis=app.redis, http=app.http)
+
+    async def render(stats_entry: CacheEntry) -> bytes:
+        return FilledResponse(
+            status=200,
+            message="Successfully retrieved web-store statistics",
+            payload=RawJSON(stats_entry.value)
+        ).encode()
+
+    response: CachedResponse = await app.chrome_stats_responses.get(entry, render)
+    return conditional_response(request, response.body, "application/json", response.headers)
 
 
 @app.post("/omegle/classify_image", tags=['Omegle'], dependencies=[Depends(RateLimiter(times=3, seconds=2))])
 async def detect_nsfw(payload: NSFWPayload):
-    return (await NSFWResponse(payload).complete()).serialize()
+    response: NSFWResponse = await NSFWResponse(payload, app.nsfw_batcher, app.nsfw_cache).complete()
+
+    # Back-pressure, tell the client (and any load balancer) to back off, but only when retrying can succeed
+    if response.retry_after is not None:
+        return response.to_response(status_code=response.status, headers={"Retry-After": str(response.retry_after)})
+
+    if response.status == status.HTTP_503_SERVICE_UNAVAILABLE:
+        return response.to_response(status_code=response.status)
+
+    return response.to_response()
+
+
+@app.get("/omegle/classify_image/cache", tags=['Omegle'], include_in_schema=False)
+async def nsfw_cache_stats():
+    return FilledResponse(
+        status=200,
+        message="Successfully retrieved classification cache statistics",
+        payload=app.nsfw_cache.stats() if app.nsfw_cache is not None else None
+    ).to_response()
+
+
+@app.get("/omegle/classify_image/ready", tags=['Omegle'], include_in_schema=False)
+async def nsfw_ready():
+    if app.nsfw_batcher is None:
+        state, message = "disabled", "Classifier disabled"
+    elif app.nsfw_batcher.failed:
+        state, message = "failed", "Classifier failed to load"
+    elif app.nsfw_batcher.ready:
+        state, message = "ready", "Classifier ready"
+    else:
+        state, message = "loading", "Classifier still loading"
+
+    code: int = status.HTTP_200_OK if state == "ready" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return FilledResponse(status=code, message=message, payload={"state": state}).to_response(status_code=code)
 
 
 @app.get("/omegle/geolocate/{address}", tags=['Omegle'], dependencies=[Depends(RateLimiter(times=1, seconds=1))], include_in_schema=False)
 async def geolocate_ip(address: str):
-    return (await GeolocateResponse(address, app.redis, app.sql_pool).complete()).serialize()
+    return (await GeolocateResponse(address, app.redis, app.sql_pool, app.http, app.geoip).complete()).to_response()
+
+
+@app.post("/omegle/geolocate/bulk", tags=['Omegle'], dependencies=[Depends(RateLimiter(times=1, seconds=1))], include_in_schema=False)
+async def geolocate_ips(payload: BulkGeolocatePayload):
+    return (await BulkGeolocateResponse(payload, app.redis, app.sql_pool, app.http, app.geoip).complete()).to_response()
 
 
 @app.get("/omegle/stats", tags=['Omegle'], dependencies=[Depends(RateLimiter(times=3, seconds=2))])
 async def retrieve_omegle_stats():
-    return (await StatResponse().complete()).serialize()
+    return (await StatResponse(app.http).complete()).to_response()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
 import enum
-from typing import Any
+import logging
+import os
+import re
+from typing import Any, List, Tuple, Optional, Set
 
 from aiomysql import Pool
 
@@ -12,6 +15,9 @@ class StatementEnum(enum.Enum):
     def __mod__(self, other):
         return str.__mod__(str(self.value), other)
 
+    def format(self, **slots) -> str:
+        return str(self.value).format(**slots)
+
     def __str__(self):
         return str(self.value)
 
@@ -55,17 +61,105 @@ def SQLEntryPoint(function):
     return wrapper
 
 
-async def create_template(pool: Pool, file_path: str) -> None:
+class MigrationStatements(StatementEnum):
+    CREATE_MIGRATIONS_TABLE: str = (
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations
+        (
+            version    INT          NOT NULL PRIMARY KEY,
+            name       VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+    GET_APPLIED_VERSIONS: str = (
+        """
+        SELECT version FROM schema_migrations
+        """
+    )
+
+    INSERT_APPLIED_VERSION: str = (
+        """
+        INSERT INTO schema_migrations (version, name) VALUES (%s, %s)
+        """
+    )
+
+    # Serializes migrations across workers starting at the same time
+    ACQUIRE_LOCK: str = (
+        """
+        SELECT GET_LOCK('chromegle_schema_migrations', %s)
+        """
+    )
+
+    RELEASE_LOCK: str = (
+        """
+        SELECT RELEASE_LOCK('chromegle_schema_migrations')
+        """
+    )
+
+
+def list_migrations(directory: str) -> List[Tuple[int, str, str]]:
+    """
+    Find the migrations in a directory, named <version>_<name>.sql (e.g. 0002_user_tracking_time_indexes.sql)
+
+    :param directory: Directory containing the .SQL files
+    :return: (version, name, path) of each migration, in version order
+
+    """
+    migrations: List[Tuple[int, str, str]] = []
+
+    for file_name in os.listdir(directory):
+        match: Optional[re.Match] = re.fullmatch(r"(\d+)_(\w+)\.sql", file_name)
+
+        if match is not None:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, file_name)))
+
+    return sorted(migrations)
+
+
+async def migrate(pool: Pool, directory: str, lock_timeout: int = 60) -> List[int]:
     """
-    Initialize a database template from a file
+    Bring the database schema up to date, applying each migration that hasn't been applied yet in version order
 
     :param pool: Pool to use to create the connection
-    :param file_path: Path for the .SQL file
-    :return: None
+    :param directory: Directory containing the versioned .SQL files
+    :param lock_timeout: Seconds to wait for another worker's migrations to finish
+    :return: Versions that were applied
 
     """
+    applied: List[int] = []
+
     async with pool.acquire() as connection:
         async with connection.cursor() as cursor:
-            await cursor.execute(open(file_path, encoding='utf-8').read())
-            await connection.commit()
+            await cursor.execute(MigrationStatements.ACQUIRE_LOCK % int(lock_timeout))
+
+            if not (await cursor.fetchone())[0]:
+                raise TimeoutError("Timed out waiting for another worker to finish migrating the database")
+
+            try:
+                await cursor.execute(str(MigrationStatements.CREATE_MIGRATIONS_TABLE))
+                await cursor.execute(str(MigrationStatements.GET_APPLIED_VERSIONS))
+                done: Set[int] = {row[0] for row in await cursor.fetchall()}
+
+                for version, name, path in list_migrations(directory):
+                    if version in done:
+                        continue
+
+                    await cursor.execute(open(path, encoding='utf-8').read())
+
+                    # Surface errors from every statement in the file, not just the first
+                    while await cursor.nextset():
+                        pass
+
+                    await cursor.execute(str(MigrationStatements.INSERT_APPLIED_VERSION), (version, name))
+                    await connection.commit()
+
+                    logging.info(f"Applied database migration {version} ({name})")
+                    applied.append(version)
+
+            finally:
+                await cursor.execute(str(MigrationStatements.RELEASE_LOCK))
+                await connection.commit()
 
+    return applied
@@ -1,11 +1,62 @@
 from __future__ import annotations
 
+import json
 from abc import ABCMeta, abstractmethod, ABC
-from typing import Any
+from typing import Any, Optional, Mapping
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Encode as compact JSON, with orjson if it's installed
+
+    """
+
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class RawJSON:
+    """
+    An already-encoded JSON value (e.g. straight from Redis), spliced into responses as-is
+
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: bytes):
+        self.value: bytes = value
+
+
+class APIJSONResponse(Response):
+    """
+    Renders API responses (or any JSON-able content) straight to bytes, skipping FastAPI's jsonable_encoder
+
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, APIResponse):
+            return content.encode()
+
+        if isinstance(content, RawJSON):
+            return content.value
+
+        return dumps(content)
 
 
 class APIResponse:
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
     @property
     def status(self) -> int:
@@ -26,8 +77,27 @@ class APIResponse:
             "payload": self.payload
         }
 
+    def encode(self) -> bytes:
+        """
+        Same as `serialize`, as JSON bytes (a RawJSON payload is included without being decoded)
+
+        """
+
+        payload: Any = self.payload
+
+        return b"".join((
+            b'{"status":', dumps(self.status),
+            b',"message":', dumps(self.message),
+            b',"payload":', payload.value if isinstance(payload, RawJSON) else dumps(payload),
+            b"}"
+        ))
+
+    def to_response(self, status_code: int = 200, headers: Optional[Mapping[str, str]] = None) -> APIJSONResponse:
+        return APIJSONResponse(self, status_code=status_code, headers=headers)
+
 
 class FilledResponse(APIResponse, ABC):
+    __slots__ = ("_status", "_message", "_payload")
 
     def __init__(self, status: int = None, message: str = None, payload: dict = None):
         self._status: int = status
@@ -48,6 +118,7 @@ class FilledResponse(APIResponse, ABC):
 
 
 class AsyncResponse(FilledResponse, ABC):
+    __slots__ = ()
 
     @abstractmethod
     async def complete(self) -> AsyncResponse:
@@ -55,6 +126,7 @@ class AsyncResponse(FilledResponse, ABC):
 
 
 class SyncResponse(FilledResponse, ABC):
+    __slots__ = ()
 
     @abstractmethod
     def complete(self) -> SyncResponse:
@@ -0,0 +1,9 @@
+# noinspection SqlNoDataSourceInspectionForFile
+
+/*
+ Recent-activity lookups filter on each timestamp, make them index range scans
+ */
+ALTER TABLE user_tracking
+    ADD INDEX IF NOT EXISTS idx_chat_started (chat_started),
+    ADD INDEX IF NOT EXISTS idx_chat_ended (chat_ended),
+    ADD INDEX IF NOT EXISTS idx_omegle_opened (omegle_opened);
@@ -0,0 +1,44 @@
+# noinspection SqlNoDataSourceInspectionForFile
+
+/*
+ Store SHA-1 address hashes as 20 raw bytes instead of 40+ hex characters
+
+ Rows whose address isn't a hex SHA-1 can't be converted, they are moved to user_tracking_invalid (not deleted) for
+ an operator to review. Every step is guarded so a partially applied run (each ALTER commits on its own) can re-run.
+ */
+CREATE TABLE IF NOT EXISTS user_tracking_invalid
+(
+    address       VARCHAR(48) NOT NULL PRIMARY KEY,
+
+    chat_started  TIMESTAMP   NULL,
+    chat_ended    TIMESTAMP   NULL,
+    omegle_opened TIMESTAMP   NULL,
+
+    moved_at      TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+BEGIN NOT ATOMIC
+    -- Only while address is still the hex column, never against the converted table
+    IF EXISTS (
+        SELECT * FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_tracking' AND COLUMN_NAME = 'address' AND DATA_TYPE = 'varchar'
+    ) THEN
+        INSERT IGNORE INTO user_tracking_invalid (address, chat_started, chat_ended, omegle_opened)
+        SELECT address, chat_started, chat_ended, omegle_opened
+        FROM user_tracking
+        WHERE address NOT REGEXP '^[0-9a-fA-F]{40}$';
+
+        -- Only what is now safely copied
+        DELETE FROM user_tracking WHERE address IN (SELECT address FROM user_tracking_invalid);
+
+        ALTER TABLE user_tracking ADD COLUMN IF NOT EXISTS address_bin BINARY(20) NULL FIRST;
+
+        UPDATE user_tracking SET address_bin = UNHEX(address) WHERE address_bin IS NULL;
+
+        ALTER TABLE user_tracking
+            DROP PRIMARY KEY,
+            DROP COLUMN address,
+            CHANGE address_bin address BINARY(20) NOT NULL,
+            ADD PRIMARY KEY (address);
+    END IF;
+END;
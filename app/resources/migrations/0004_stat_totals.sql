@@ -0,0 +1,22 @@
+# noinspection SqlNoDataSourceInspectionForFile
+
+/*
+ Incrementally maintained all-time totals, so they never need a SUM over all of stat_tracking
+ */
+CREATE TABLE IF NOT EXISTS stat_totals
+(
+    id            TINYINT NOT NULL PRIMARY KEY,
+
+    chat_started  BIGINT  NOT NULL DEFAULT 0,
+    chat_ended    BIGINT  NOT NULL DEFAULT 0,
+    omegle_opened BIGINT  NOT NULL DEFAULT 0
+
+);
+
+INSERT INTO stat_totals (id, chat_started, chat_ended, omegle_opened)
+SELECT 1, COALESCE(SUM(chat_started), 0), COALESCE(SUM(chat_ended), 0), COALESCE(SUM(omegle_opened), 0)
+FROM stat_tracking
+ON DUPLICATE KEY UPDATE
+    chat_started=VALUES(chat_started),
+    chat_ended=VALUES(chat_ended),
+    omegle_opened=VALUES(omegle_opened);
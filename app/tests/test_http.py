@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, List
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from utilities.http import HTTPClient
+
+Handler = Callable[[web.Request], Awaitable[web.Response]]
+
+
+def run(handler: Handler, test: Callable[[HTTPClient, str], Awaitable[None]], **client: float) -> None:
+    """
+    Serve `handler` on a local stub server and run `test` against it with a started HTTPClient
+
+    """
+
+    async def main() -> None:
+        application: web.Application = web.Application()
+        application.router.add_get("/stat", handler)
+
+        async with TestServer(application) as server:
+            http: HTTPClient = HTTPClient(**client)
+            await http.start()
+
+            try:
+                await test(http, str(server.make_url("/stat")))
+            finally:
+                await http.close()
+
+    asyncio.run(main())
+
+
+def test_retries_503_then_succeeds():
+    hits: List[float] = []
+
+    async def handler(_: web.Request) -> web.Response:
+        hits.append(time.monotonic())
+        return web.Response(status=503) if len(hits) == 1 else web.json_response({"value": "ok"})
+
+    async def test(http: HTTPClient, url: str) -> None:
+        assert await http.get_json(url) == {"value": "ok"}
+
+    run(handler, test, retries=1, backoff=0.01)
+    assert len(hits) == 2
+
+
+def test_error_raised_when_retries_exhausted():
+    hits: List[float] = []
+
+    async def handler(_: web.Request) -> web.Response:
+        hits.append(time.monotonic())
+        return web.json_response({"message": "unavailable"}, status=503)
+
+    async def test(http: HTTPClient, url: str) -> None:
+        # The error body is never mistaken for data
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await http.get_json(url, retries=1)
+
+        assert error.value.status == 503
+
+    run(handler, test, backoff=0.01)
+    assert len(hits) == 2
+
+
+def test_client_error_not_retried():
+    hits: List[float] = []
+
+    async def handler(_: web.Request) -> web.Response:
+        hits.append(time.monotonic())
+        return web.json_response({"message": "not found"}, status=404)
+
+    async def test(http: HTTPClient, url: str) -> None:
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await http.get_json(url, retries=3)
+
+        assert error.value.status == 404
+
+    run(handler, test, backoff=0.01)
+    assert len(hits) == 1
+
+
+def test_timeout_is_retried_then_raised():
+    hits: List[float] = []
+
+    async def handler(_: web.Request) -> web.Response:
+        hits.append(time.monotonic())
+        await asyncio.sleep(1)
+        return web.json_response({"value": "late"})
+
+    async def test(http: HTTPClient, url: str) -> None:
+        with pytest.raises(asyncio.TimeoutError):
+            await http.get_json(url, timeout=0.05, retries=1)
+
+    run(handler, test, backoff=0.01)
+    assert len(hits) == 2
+
+
+def test_backoff_doubles_between_attempts():
+    hits: List[float] = []
+
+    async def handler(_: web.Request) -> web.Response:
+        hits.append(time.monotonic())
+        return web.Response(status=503) if len(hits) < 3 else web.json_response({"value": "ok"})
+
+    async def test(http: HTTPClient, url: str) -> None:
+        assert await http.get_json(url, retries=2) == {"value": "ok"}
+
+    run(handler, test, backoff=0.1)
+
+    assert len(hits) == 3
+    assert hits[1] - hits[0] >= 0.1
+    assert hits[2] - hits[1] >= 0.2
@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Optional, Set, Hashable, Dict
+
+import aioredis
+
+from models.response import dumps
+from utilities.lru import LRUCache
+
+Builder = Callable[[], Awaitable[Any]]
+
+
+def make_etag(value: bytes) -> str:
+    return '"%s"' % hashlib.sha1(value).hexdigest()[:20]
+
+
+class CacheEntry:
+    """
+    A cached value as stored, with the version it was stored under & when it was built
+
+    """
+
+    def __init__(self, value: bytes, etag: str, built_at: float, ttl: int, stale_ttl: int):
+        self.value: bytes = value
+        self.etag: str = etag
+        self.built_at: float = built_at
+        self.ttl: int = ttl
+        self.stale_ttl: int = stale_ttl
+
+
+class SharedCache:
+    """
+    Redis-backed cache of one expensive value, with stampede protection
+
+    - Single-flight: concurrent misses in a process share one rebuild, and a Redis `SET NX` lock lets only one worker
+      in the fleet rebuild at a time (the others wait for its result)
+    - Stale-while-revalidate: for `stale_ttl` seconds after going stale the old value is still served while a
+      rebuild happens in the background
+    - Refresh-ahead: a background rebuild also starts once the value is within `refresh_ahead` seconds of going stale
+
+    """
+
+    LOCK_POLL_INTERVAL: float = 0.05
+
+    # Only delete the lock if we still own it
+    RELEASE_LOCK_SCRIPT: str = (
+        """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+        """
+    )
+
+    def __init__(self, key: str, ttl: int, stale_ttl: int = 0, refresh_ahead: int = 0, lock_ttl: int = 30):
+        self.key: str = key
+        self.ttl: int = ttl
+        self.stale_ttl: int = stale_ttl
+        self.refresh_ahead: int = refresh_ahead
+        self.lock_ttl: int = lock_ttl
+
+        self._inflight: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+
+    @property
+    def fresh_key(self) -> str:
+        return f"{self.key}:fresh-until"
+
+    @property
+    def lock_key(self) -> str:
+        return f"{self.key}:lock"
+
+    @property
+    def version_key(self) -> str:
+        return f"{self.key}:version"
+
+    async def get(self, redis: aioredis.Redis, builder: Builder) -> Any:
+        """
+        Get the cached value, building it if there is nothing (not even a stale value) to serve
+
+        """
+
+        raw: bytes = await self.get_raw(redis, builder)
+        return json.loads(raw.decode("utf-8"))
+
+    async def get_raw(self, redis: aioredis.Redis, builder: Builder) -> bytes:
+        """
+        Same as `get`, but returns the JSON-encoded bytes exactly as stored
+
+        """
+
+        return (await self.get_entry(redis, builder)).value
+
+    async def get_entry(self, redis: aioredis.Redis, builder: Builder) -> CacheEntry:
+        """
+        Same as `get_raw`, along with the value's version (ETag) & build time
+
+        """
+
+        value, fresh_until, version = await redis.mget(self.key, self.fresh_key, self.version_key)
+
+        # Just built, its version is derived rather than read back (another rebuild could have landed in between)
+        if value is None:
+            value, version = await self._single_flight(redis, builder, wait=True), None
+
+        # Stale (or about to be), serve it anyway & let one worker rebuild behind the scenes
+        elif fresh_until is None or time.time() >= float(fresh_until) - self.refresh_ahead:
+            self._refresh_in_background(redis, builder)
+
+        # Written in the same transaction as the value, so a single MGET always sees a matching pair
+        meta: Dict[str, Any] = (
+            {"etag": make_etag(value), "built_at": time.time()} if version is None else json.loads(version.decode("utf-8"))
+        )
+
+        return CacheEntry(value, meta["etag"], meta["built_at"], self.ttl, self.stale_ttl)
+
+    async def refresh(self, redis: aioredis.Redis, builder: Builder) -> Optional[bytes]:
+        """
+        Rebuild the value now (unless another worker is already doing so)
+
+        :return: The new value, or None if another worker holds the lock
+
+        """
+
+        return await self._single_flight(redis, builder, wait=False)
+
+    async def set(self, redis: aioredis.Redis, value: Any) -> bytes:
+        raw: bytes = dumps(value)
+        built_at: float = time.time()
+
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(self.key, raw, ex=self.ttl + self.stale_ttl)
+            pipe.set(self.fresh_key, str(built_at + self.ttl), ex=self.ttl)
+            pipe.set(self.version_key, json.dumps({"etag": make_etag(raw), "built_at": built_at}), ex=self.ttl + self.stale_ttl)
+            await pipe.execute()
+
+        return raw
+
+    def _refresh_in_background(self, redis: aioredis.Redis, builder: Builder) -> None:
+        if self._inflight is not None:
+            return
+
+        task: asyncio.Task = asyncio.create_task(self._single_flight(redis, builder, wait=False))
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Failed to refresh {self.key}", exc_info=task.exception())
+
+    async def _single_flight(self, redis: aioredis.Redis, builder: Builder, wait: bool) -> Optional[bytes]:
+        # Share one rebuild between everything in this process
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._rebuild(redis, builder, wait))
+            self._inflight.add_done_callback(self._inflight_done)
+
+        value: Optional[bytes] = await asyncio.shield(self._inflight)
+
+        # Joined a background refresh that deferred to another worker, but this caller needs a value
+        if value is None and wait:
+            return await self._rebuild(redis, builder, wait)
+
+        return value
+
+    def _inflight_done(self, _: asyncio.Task) -> None:
+        self._inflight = None
+
+    async def _rebuild(self, redis: aioredis.Redis, builder: Builder, wait: bool) -> Optional[bytes]:
+        token: str = uuid.uuid4().hex
+
+        # Another worker is rebuilding, wait for its value rather than doing the same work
+        if not await redis.set(self.lock_key, token, nx=True, ex=self.lock_ttl):
+            if not wait:
+                return None
+
+            deadline: float = time.monotonic() + self.lock_ttl
+
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+                value: Optional[bytes] = await redis.get(self.key)
+
+                if value is not None:
+                    return value
+
+            # Lock holder died or is too slow, build it ourselves
+            return await self.set(redis, await builder())
+
+        try:
+            return await self.set(redis, await builder())
+        finally:
+            await redis.eval(self.RELEASE_LOCK_SCRIPT, 1, self.lock_key, token)
+
+
+class CachedResponse:
+    """
+    A fully serialized response body & the HTTP caching headers that go with it
+
+    """
+
+    def __init__(self, body: bytes, entry: CacheEntry):
+        self.body: bytes = body
+        self.etag: str = make_etag(body)
+        self.built_at: float = entry.built_at
+        self.ttl: int = entry.ttl
+        self.stale_ttl: int = entry.stale_ttl
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "ETag": self.etag,
+            "Age": str(max(0, int(time.time() - self.built_at))),
+            "Cache-Control": f"public, max-age={self.ttl}, stale-while-revalidate={self.stale_ttl}"
+        }
+
+
+Renderer = Callable[[CacheEntry], Awaitable[bytes]]
+
+
+class ResponseCache:
+    """
+    Serialized responses per version of a SharedCache value, so an unchanged value is never re-serialized
+
+    A `variant` distinguishes different responses built from the same value (e.g. query options).
+
+    """
+
+    def __init__(self, max_size: int = 16):
+        self._responses: LRUCache = LRUCache(max_size=max_size)
+
+    async def get(self, entry: CacheEntry, render: Renderer, variant: Hashable = None) -> CachedResponse:
+        key: Hashable = (entry.etag, variant)
+        response: Optional[CachedResponse] = self._responses.get(key)
+
+        if response is None:
+            response = CachedResponse(await render(entry), entry)
+            self._responses.set(key, response)
+
+        return response
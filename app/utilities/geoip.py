@@ -0,0 +1,222 @@
+"""
+Offline IP geolocation
+
+Compiled database layout (native byte order, every section naturally aligned):
+
+    header       MAGIC, VERSION, v4 range count, v6 range count, countries JSON length (padded to 32 bytes)
+    v6 starts    uint64 * n6 (upper 64 bits of each IPv6 range start, sorted)
+    v6 ends      uint64 * n6
+    v4 starts    uint32 * n4 (sorted)
+    v4 ends      uint32 * n4
+    v6 country   uint16 * n6 (index into the countries table)
+    v4 country   uint16 * n4
+    countries    JSON list of [country_code, country_name]
+"""
+
+import argparse
+import array
+import bisect
+import csv
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+MAGIC: bytes = b"CGIP"
+VERSION: int = 1
+HEADER: struct.Struct = struct.Struct("=4sIIII12x")
+
+
+def _parse_ip(value: str) -> Union[ipaddress.IPv4Address, ipaddress.IPv6Address]:
+    value = value.strip()
+    return ipaddress.ip_address(int(value) if value.isdigit() else value)
+
+
+def compile_csv(csv_path: str, output_path: str) -> Tuple[int, int]:
+    """
+    Compile an IP-range CSV (start_ip, end_ip, country_code[, country_name], dotted or integer addresses) into the
+    memory-mappable format read by IPRangeDatabase
+
+    :return: Number of IPv4 & IPv6 ranges written
+
+    """
+    countries: List[List[str]] = []
+    country_index: Dict[str, int] = {}
+    v4: List[Tuple[int, int, int]] = []
+    v6: List[Tuple[int, int, int]] = []
+
+    with open(csv_path, newline='', encoding='utf-8') as file:
+        for row in csv.reader(file):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+
+            try:
+                start, end = _parse_ip(row[0]), _parse_ip(row[1])
+            except ValueError:
+                continue  # Header or junk
+
+            code: str = row[2].strip().upper()
+
+            if code not in country_index:
+                country_index[code] = len(countries)
+                countries.append([code, row[3].strip() if len(row) > 3 else None])
+
+            if start.version == 4:
+                v4.append((int(start), int(end), country_index[code]))
+            else:
+                v6.append((int(start) >> 64, int(end) >> 64, country_index[code]))
+
+    v4.sort()
+    v6.sort()
+    countries_json: bytes = json.dumps(countries).encode("utf-8")
+
+    # Write to a temporary file then rename, so workers never map a half-written database
+    temporary_path: str = f"{output_path}.{os.getpid()}.tmp"
+
+    with open(temporary_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(v4), len(v6), len(countries_json)))
+        array.array("Q", [r[0] for r in v6]).tofile(file)
+        array.array("Q", [r[1] for r in v6]).tofile(file)
+        array.array("I", [r[0] for r in v4]).tofile(file)
+        array.array("I", [r[1] for r in v4]).tofile(file)
+        array.array("H", [r[2] for r in v6]).tofile(file)
+        array.array("H", [r[2] for r in v4]).tofile(file)
+        file.write(countries_json)
+
+    os.replace(temporary_path, output_path)
+    return len(v4), len(v6)
+
+
+class IPRangeDatabase:
+    """
+    Offline IP to country lookups over a compiled, memory-mapped range database (see compile_csv)
+
+    The file is mapped read-only, so every worker on the host shares the same pages. Lookups are a binary search over
+    the sorted range starts, and the file is re-mapped when it changes on disk (checked at most every
+    `reload_interval` seconds).
+
+    """
+
+    def __init__(self, path: str, languages: Optional[Dict[str, List[str]]] = None, reload_interval: float = 60):
+        self.path: str = path
+        self.languages: Dict[str, List[str]] = languages or {}
+        self.reload_interval: float = reload_interval
+
+        self._mtime: Optional[float] = None
+        self._checked: float = 0
+        self._map: Optional[mmap.mmap] = None
+        self._v4: Tuple[memoryview, memoryview, memoryview] = (memoryview(b""),) * 3
+        self._v6: Tuple[memoryview, memoryview, memoryview] = (memoryview(b""),) * 3
+        self._countries: List[dict] = []
+
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self._v4[0]) + len(self._v6[0])
+
+    def reload(self) -> bool:
+        """
+        (Re-)map the database file
+
+        :return: Whether a new version of the file was loaded
+
+        """
+        self._checked = time.monotonic()
+        mtime: float = os.stat(self.path).st_mtime
+
+        if mtime == self._mtime:
+            return False
+
+        with open(self.path, "rb") as file:
+            mapped: mmap.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n4, n6, countries_length = HEADER.unpack_from(mapped, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} IP range database")
+
+        view: memoryview = memoryview(mapped)
+        offset: int = HEADER.size
+        sections: List[memoryview] = []
+
+        for fmt, count in (("Q", n6), ("Q", n6), ("I", n4), ("I", n4), ("H", n6), ("H", n4)):
+            size: int = array.array(fmt).itemsize * count
+            sections.append(view[offset:offset + size].cast(fmt))
+            offset += size
+
+        countries: List[dict] = []
+
+        # Join in the spoken languages once, here, rather than on every lookup
+        for code, name in json.loads(bytes(view[offset:offset + countries_length]).decode("utf-8")):
+            country: dict = {"country_code": code}
+
+            if name:
+                country["country"] = name
+
+            if self.languages.get(code) is not None:
+                country["language"] = self.languages[code]
+
+            countries.append(country)
+
+        # Swap everything in at once, the old mapping is released once nothing references it
+        self._v6 = (sections[0], sections[1], sections[4])
+        self._v4 = (sections[2], sections[3], sections[5])
+        self._countries = countries
+        self._map, self._mtime = mapped, mtime
+        return True
+
+    def _maybe_reload(self) -> None:
+        if time.monotonic() - self._checked < self.reload_interval:
+            return
+
+        try:
+            self.reload()
+        except (OSError, ValueError):
+            self._checked = time.monotonic()
+
+    def lookup(self, ip: str) -> Optional[dict]:
+        """
+        Geolocate an address
+
+        :return: The address' country_code (plus country & language where known), or None if not in the database
+
+        """
+        self._maybe_reload()
+
+        try:
+            address: Union[ipaddress.IPv4Address, ipaddress.IPv6Address] = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        if address.version == 4:
+            key, (starts, ends, indexes) = int(address), self._v4
+        else:
+            key, (starts, ends, indexes) = int(address) >> 64, self._v6
+
+        position: int = bisect.bisect_right(starts, key) - 1
+
+        if position < 0 or key > ends[position]:
+            return None
+
+        return {"ip": ip, **self._countries[indexes[position]]}
+
+
+def main(args=None):
+    # noinspection PyTypeChecker
+    parser = argparse.ArgumentParser(description="""Compile an IP-range CSV into an offline geolocation database""")
+    parser.add_argument('csv_path', type=str, help='CSV of start_ip, end_ip, country_code[, country_name]')
+    parser.add_argument('output_path', type=str, help='Where to write the compiled database')
+    config = vars(parser.parse_args(args))
+
+    v4, v6 = compile_csv(config['csv_path'], config['output_path'])
+    print(f"Compiled {v4} IPv4 & {v6} IPv6 ranges into {config['output_path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+import aiohttp
+
+
+class HTTPClient:
+    """
+    Application-scoped HTTP client, one pooled keep-alive session shared by every outbound request
+
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 20,
+            dns_cache_ttl: int = 300,
+            keepalive_timeout: float = 30,
+            timeout: float = 10,
+            retries: int = 1,
+            backoff: float = 0.2
+    ):
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.dns_cache_ttl: int = dns_cache_ttl
+        self.keepalive_timeout: float = keepalive_timeout
+        self.timeout: float = timeout
+        self.retries: int = retries
+        self.backoff: float = backoff
+
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        if self.session is not None:
+            return
+
+        connector: aiohttp.TCPConnector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout
+        )
+
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_json(self, url: str, timeout: Optional[float] = None, retries: Optional[int] = None) -> Any:
+        """
+        GET a URL and decode its JSON body, retrying connection errors, timeouts & retryable statuses
+
+        :param url: URL to request
+        :param timeout: Total seconds allowed per attempt (defaults to the client's)
+        :param retries: Extra attempts after the first (defaults to the client's)
+        :raises aiohttp.ClientResponseError: If the final attempt (or any attempt, for a non-retryable status) wasn't 2xx
+        :raises aiohttp.ClientError: If every attempt failed
+        :raises asyncio.TimeoutError: If every attempt timed out
+
+        """
+
+        retries = self.retries if retries is None else retries
+        client_timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=self.timeout if timeout is None else timeout)
+
+        for attempt in range(retries + 1):
+            try:
+                async with self.session.get(url, timeout=client_timeout) as request:
+                    # Error bodies are never returned as data
+                    request.raise_for_status()
+                    return await request.json()
+
+            # Wrong content type won't fix itself
+            except aiohttp.ContentTypeError:
+                raise
+
+            except aiohttp.ClientResponseError as ex:
+                if ex.status not in self.RETRY_STATUSES or attempt >= retries:
+                    raise
+
+                logging.warning(f"Retrying {url} after HTTP {ex.status} (attempt {attempt + 1} of {retries + 1})")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                if attempt >= retries:
+                    raise
+
+                logging.warning(f"Retrying {url} after {type(ex).__name__} (attempt {attempt + 1} of {retries + 1})")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
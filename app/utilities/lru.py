@@ -0,0 +1,54 @@
+import collections
+import time
+from typing import Any, Optional, Hashable, Tuple, OrderedDict
+
+
+class LRUCache:
+    """
+    Size-bounded, in-process least-recently-used cache with an optional per-entry time-to-live
+
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size: int = max(1, max_size)
+        self.ttl: Optional[float] = ttl
+        self._entries: OrderedDict[Hashable, Tuple[Any, Optional[float]]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry: Optional[Tuple[Any, Optional[float]]] = self._entries.get(key)
+
+        if entry is None:
+            return default
+
+        value, expires = entry
+
+        # Expired
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (value, None if ttl is None else time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry: Optional[Tuple[Any, Optional[float]]] = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -1,7 +1,9 @@
 import hashlib
-from typing import Optional
+from typing import Optional, List, Mapping
 
+from starlette import status
 from starlette.requests import Request
+from starlette.responses import Response
 
 
 def hash_address(ip: str) -> str:
@@ -12,3 +14,30 @@ def get_address(request: Request, hashed: bool = True) -> str:
     ip: Optional[str] = request.headers.get("cf-connecting-ip", None)
     ip: Optional[str] = str(request.client.host if ip is None else ip)
     return hash_address(ip) if hashed else ip
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Whether the client's If-None-Match already names this (strong) ETag
+
+    """
+
+    header: Optional[str] = request.headers.get("if-none-match", None)
+
+    if header is None:
+        return False
+
+    tags: List[str] = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def conditional_response(request: Request, content: bytes, media_type: str, headers: Mapping[str, str]) -> Response:
+    """
+    Respond with the content, or an empty 304 if the client already has it (headers must include its ETag)
+
+    """
+
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content=content, media_type=media_type, headers=headers)
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import traceback
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional, List, Tuple, Set
+
+import numpy as np
+
+from utilities import nsfw_predict
+
+# Model held by each worker of a process pool (models can't be pickled across processes)
+_WORKER_MODEL = None
+
+
+def _worker_init(model_path: str, backend: str, max_batch_size: Optional[int] = None) -> None:
+    global _WORKER_MODEL
+    _WORKER_MODEL = _load_model(model_path, backend, max_batch_size)
+
+
+def _load_model(model_path: str, backend: str, max_batch_size: Optional[int] = None) -> nsfw_predict.ModelBackend:
+    return nsfw_predict.warm_up(nsfw_predict.load_model(model_path, backend, max_batch_size))
+
+
+def _worker_ready() -> bool:
+    return _WORKER_MODEL is not None
+
+
+def _worker_predict(nd_images: np.ndarray) -> np.ndarray:
+    return nsfw_predict.predict_nd(_WORKER_MODEL, nd_images)
+
+
+def create_executor(
+        kind: str,
+        max_workers: int,
+        model_path: Optional[str] = None,
+        backend: str = "keras",
+        max_batch_size: Optional[int] = None
+) -> Executor:
+    """
+    Create the pool that image preprocessing & inference run on
+
+    :param kind: Either "thread" or "process"
+    :param max_workers: Number of workers in the pool
+    :param model_path: Model each process loads for itself (process pools only)
+    :param backend: Backend each process loads the model with (process pools only)
+    :param max_batch_size: Largest batch each process's model is sized for (process pools only)
+    :return: The executor
+
+    """
+
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nsfw")
+
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=_worker_init, initargs=(model_path, backend, max_batch_size))
+
+    raise ValueError(f"Unknown executor kind '{kind}', expected 'thread' or 'process'")
+
+
+class NSFWUnavailable(Exception):
+    """
+    Raised when an image can't be accepted for classification right now
+
+    """
+
+
+class NSFWQueueFull(NSFWUnavailable):
+    """
+    Raised when too many images are already waiting to be classified
+
+    """
+
+
+class NSFWNotReady(NSFWUnavailable):
+    """
+    Raised when the model is still loading
+
+    """
+
+
+class NSFWLoadFailed(NSFWUnavailable):
+    """
+    Raised when the model failed to load, it won't become ready without a restart
+
+    """
+
+
+class NSFWBatcher:
+    """
+    Dynamic micro-batching scheduler for the NSFW model
+
+    Requests are queued and flushed as a single stacked batch once either `max_batch_size` images are waiting or
+    `max_delay_ms` milliseconds have passed since the first image in the batch arrived. Preprocessing and inference
+    run on `executor` so the event loop is never blocked, and at most `max_queue_size` images may be in flight.
+
+    The model itself is loaded & warmed up in the background once started, see `ready`.
+
+    """
+
+    def __init__(
+            self,
+            model_path: str,
+            executor: Executor,
+            backend: str = "keras",
+            policy: Optional[nsfw_predict.NSFWPolicy] = None,
+            max_workers: int = 1,
+            max_batch_size: int = 16,
+            max_delay_ms: float = 10,
+            max_queue_size: int = 256
+    ):
+        self.model_path: str = model_path
+        self.backend: str = backend
+        self.policy: nsfw_predict.NSFWPolicy = policy or nsfw_predict.NSFWPolicy()
+        self.model: Optional[nsfw_predict.ModelBackend] = None
+        self.executor: Executor = executor
+        self.max_workers: int = max(1, max_workers)
+        self.max_batch_size: int = max(1, max_batch_size)
+        self.max_delay: float = max(0.0, max_delay_ms) / 1000
+        self.max_queue_size: int = max(1, max_queue_size)
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loader: Optional[asyncio.Task] = None
+        self._ready: bool = False
+        self._error: Optional[BaseException] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatches: Set[asyncio.Task] = set()
+        self._batch: List[Tuple[np.ndarray, asyncio.Future]] = []
+        self._pending: int = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def failed(self) -> bool:
+        return self._error is not None
+
+    @property
+    def saturated(self) -> bool:
+        return self._pending >= self.max_queue_size
+
+    async def start(self) -> None:
+        """
+        Start accepting images & begin loading the model in the background (doesn't wait for it)
+
+        """
+
+        if self._task is not None:
+            return
+
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._loader = asyncio.create_task(self._load())
+        self._task = asyncio.create_task(self._run())
+
+    async def _load(self) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        try:
+            # Each process loads its own copy in the pool initializer, wait for every worker to be spun up
+            if isinstance(self.executor, ProcessPoolExecutor):
+                await asyncio.gather(*[loop.run_in_executor(self.executor, _worker_ready) for _ in range(self.max_workers)])
+            else:
+                self.model = await loop.run_in_executor(self.executor, _load_model, self.model_path, self.backend, self.max_batch_size)
+
+        except Exception as ex:
+            logging.error(traceback.format_exc())
+            self._error = ex
+            return
+
+        self._ready = True
+        logging.info(f"NSFW model loaded from {self.model_path} ({self.backend})")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._loader.cancel()
+        self._task.cancel()
+
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+        self._task = None
+
+        # Let batches already handed to the executor finish
+        if self._dispatches:
+            await asyncio.gather(*self._dispatches, return_exceptions=True)
+
+        # Fail anything left behind so callers don't hang
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+
+        for _, future in self._batch:
+            if not future.done():
+                future.set_exception(RuntimeError("The NSFW batcher was stopped"))
+
+        self._batch = []
+        self.executor.shutdown(wait=False)
+
+    async def classify(self, image_bytes: bytes) -> Tuple[List[float], bool]:
+        """
+        Preprocess raw image bytes off the event loop, queue them and wait for their row of the batch
+
+        :return: The image's percentage for each of nsfw_predict.CATEGORIES & whether the policy deems it NSFW
+
+        :raises NSFWLoadFailed: If the model failed to load
+        :raises NSFWNotReady: If the model hasn't finished loading
+        :raises NSFWQueueFull: If the batcher is saturated
+
+        """
+
+        if self._task is None:
+            raise RuntimeError("The NSFW batcher has not been started")
+
+        if self._error is not None:
+            raise NSFWLoadFailed() from self._error
+
+        if not self._ready:
+            raise NSFWNotReady()
+
+        if self.saturated:
+            raise NSFWQueueFull()
+
+        self._pending += 1
+
+        try:
+            loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+            image: np.ndarray = await loop.run_in_executor(
+                self.executor, nsfw_predict.load_image_bytes, image_bytes, (nsfw_predict.IMAGE_DIM, nsfw_predict.IMAGE_DIM)
+            )
+
+            future: asyncio.Future = loop.create_future()
+            self._queue.put_nowait((image, future))
+            return await future
+
+        finally:
+            self._pending -= 1
+
+    async def _collect(self) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        self._batch = batch = [await self._queue.get()]
+        deadline: float = asyncio.get_running_loop().time() + self.max_delay
+
+        while len(batch) < self.max_batch_size:
+            remaining: float = deadline - asyncio.get_running_loop().time()
+
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        self._batch = []
+        return batch
+
+    async def _predict(self, images: List[np.ndarray]) -> np.ndarray:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        if isinstance(self.executor, ProcessPoolExecutor):
+            return await loop.run_in_executor(self.executor, _worker_predict, np.stack(images))
+
+        return await loop.run_in_executor(self.executor, nsfw_predict.predict_nd, self.model, np.stack(images))
+
+    async def _dispatch(self, batch: List[Tuple[np.ndarray, asyncio.Future]]) -> None:
+        futures: List[asyncio.Future] = [future for _, future in batch]
+
+        try:
+            percentages: np.ndarray = await self._predict([image for image, _ in batch])
+            flags: np.ndarray = self.policy.evaluate(percentages)
+
+        except Exception as ex:
+            logging.error(traceback.format_exc())
+
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ex)
+
+            return
+
+        finally:
+            self._slots.release()
+
+        for future, row, flag in zip(futures, percentages.tolist(), flags.tolist()):
+            # Caller may have gone away (e.g. client disconnected)
+            if not future.done():
+                future.set_result((row, flag))
+
+    async def _run(self) -> None:
+        while True:
+            # Only collect a new batch once a worker is free to take it
+            await self._slots.acquire()
+
+            try:
+                batch = await self._collect()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+
+            task: asyncio.Task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
@@ -0,0 +1,63 @@
+import hashlib
+import json
+from typing import Optional, List
+
+import aioredis
+
+from utilities.lru import LRUCache
+
+
+class NSFWCache:
+    """
+    Two-tier (in-process LRU, then Redis) cache of model predictions keyed by a hash of the image bytes, each
+    prediction is stored as its row of percentages (see nsfw_predict.CATEGORIES)
+
+    """
+
+    PREFIX: str = "chromegle:nsfw:"
+
+    def __init__(self, redis: aioredis.Redis, max_size: int = 4096, expiry: int = 86400):
+        self.redis: aioredis.Redis = redis
+        self.expiry: int = expiry
+        self.local: LRUCache = LRUCache(max_size)
+
+        self.local_hits: int = 0
+        self.redis_hits: int = 0
+        self.misses: int = 0
+
+    @classmethod
+    def digest(cls, image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    async def get(self, digest: str) -> Optional[List[float]]:
+        row: Optional[List[float]] = self.local.get(digest)
+
+        if row is not None:
+            self.local_hits += 1
+            return list(row)
+
+        cached: Optional[bytes] = await self.redis.get(self.PREFIX + digest)
+
+        if cached is None:
+            self.misses += 1
+            return None
+
+        row = json.loads(cached.decode("utf-8"))
+        self.local.set(digest, tuple(row))
+        self.redis_hits += 1
+        return row
+
+    async def set(self, digest: str, row: List[float]) -> None:
+        self.local.set(digest, tuple(row))
+        await self.redis.set(self.PREFIX + digest, json.dumps(row), ex=self.expiry)
+
+    def stats(self) -> dict:
+        lookups: int = self.local_hits + self.redis_hits + self.misses
+
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.local_hits + self.redis_hits) / lookups, 4) if lookups else 0.0,
+            "local_size": len(self.local)
+        }
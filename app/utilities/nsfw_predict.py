@@ -1,14 +1,17 @@
 import argparse
+import io
 import json
+import threading
 from os import listdir
 from os.path import isfile, join, exists, isdir, abspath
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_hub as hub
-from tensorflow import keras
+from PIL import Image
+
+# ML runtimes (tensorflow, tflite_runtime, onnxruntime) are imported lazily so processes that never load a model don't pay for them
 
 IMAGE_DIM = 224  # required/default image dimensionality
+CATEGORIES = ['drawings', 'hentai', 'neutral', 'porn', 'sexy']  # model output order
 
 
 def load_images(image_paths, image_size, verbose=False):
@@ -24,6 +27,8 @@ def load_images(image_paths, image_size, verbose=False):
         loaded_image_indexes: paths of nsfw_images which the function is able to process
 
     """
+    from tensorflow import keras
+
     loaded_images = []
     loaded_image_paths = []
 
@@ -50,13 +55,185 @@ def load_images(image_paths, image_size, verbose=False):
     return np.asarray(loaded_images), loaded_image_paths
 
 
-def load_model(model_path):
+def load_image_bytes(image_bytes, image_size):
+    """
+    Function for decoding an in-memory image into a numpy array for passing to model.predict
+    inputs:
+        image_bytes: raw (already base64-decoded) bytes of the image
+        image_size: size into which the image should be resized
+
+    outputs:
+        loaded_image: normalized float32 array of shape (height, width, 3)
+
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # Matches keras.preprocessing.image.load_img (RGB, nearest-neighbour resize)
+        image = image.convert("RGB").resize((image_size[1], image_size[0]), Image.NEAREST)
+        loaded_image = np.asarray(image, dtype=np.float32)
+
+    return loaded_image / 255
+
+
+class ModelBackend:
+    """
+    Common interface for every way of running the five-class model, `predict` takes a float32 batch of shape
+    (n, IMAGE_DIM, IMAGE_DIM, 3) normalized to [0, 1] and returns an (n, 5) array of probabilities
+
+    """
+
+    def __init__(self, model_path, max_batch_size=None):
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+
+    def predict(self, nd_images):
+        raise NotImplementedError
+
+
+class KerasBackend(ModelBackend):
+    """ Full Keras model (.h5 or SavedModel)...."""
+
+    def __init__(self, model_path, max_batch_size=None):
+        super().__init__(model_path, max_batch_size)
+
+        import tensorflow as tf
+        import tensorflow_hub as hub
+
+        self.model = tf.keras.models.load_model(model_path, custom_objects={
+            'KerasLayer': hub.KerasLayer}, compile=False)
+
+    def predict(self, nd_images):
+        return self.model.predict(nd_images)
+
+
+class TFLiteBackend(ModelBackend):
+    """ Converted (float32, float16 or int8 quantized) TFLite model, see convert_tflite...."""
+
+    def __init__(self, model_path, max_batch_size=None):
+        super().__init__(model_path, max_batch_size)
+
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        # Interpreters aren't thread-safe, and the executor may predict several batches at once
+        self.lock = threading.Lock()
+        self.interpreter = Interpreter(model_path=model_path)
+        input_index = self.interpreter.get_input_details()[0]['index']
+        input_shape = self.interpreter.get_input_details()[0]['shape']
+
+        # Allocated once at a fixed batch size, smaller batches are padded & larger ones split, never re-allocated
+        self.batch_size = int(max_batch_size or input_shape[0] or 1)
+        if self.batch_size != input_shape[0]:
+            self.interpreter.resize_tensor_input(input_index, [self.batch_size, *input_shape[1:]])
+
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+
+    def predict(self, nd_images):
+        preds = []
+
+        with self.lock:
+            for start in range(0, len(nd_images), self.batch_size):
+                chunk = nd_images[start:start + self.batch_size]
+                padded = np.zeros((self.batch_size, *chunk.shape[1:]), dtype=chunk.dtype)
+                padded[:len(chunk)] = chunk
+
+                self.interpreter.set_tensor(self.input_details['index'], self._quantize(padded, self.input_details))
+                self.interpreter.invoke()
+                preds.append(self._dequantize(self.interpreter.get_tensor(self.output_details['index'])[:len(chunk)], self.output_details))
+
+        return np.concatenate(preds)
+
+    @staticmethod
+    def _quantize(nd_images, details):
+        scale, zero_point = details['quantization']
+
+        if details['dtype'] == np.float32 or not scale:
+            return nd_images.astype(details['dtype'])
+
+        return np.round(nd_images / scale + zero_point).astype(details['dtype'])
+
+    @staticmethod
+    def _dequantize(preds, details):
+        scale, zero_point = details['quantization']
+
+        if details['dtype'] == np.float32 or not scale:
+            return preds.astype(np.float32)
+
+        return (preds.astype(np.float32) - zero_point) * scale
+
+
+class ONNXBackend(ModelBackend):
+    """ ONNX export of the model, run through ONNX Runtime on the CPU...."""
+
+    def __init__(self, model_path, max_batch_size=None):
+        super().__init__(model_path, max_batch_size)
+
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, nd_images):
+        return self.session.run(None, {self.input_name: nd_images.astype(np.float32)})[0]
+
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'tflite': TFLiteBackend,
+    'onnx': ONNXBackend
+}
+
+
+def load_model(model_path, backend='keras', max_batch_size=None):
     if model_path is None or not exists(model_path):
         raise ValueError(
             "saved_model_path must be the valid directory of a saved model to load.")
 
-    model = tf.keras.models.load_model(model_path, custom_objects={
-        'KerasLayer': hub.KerasLayer}, compile=False)
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"backend must be one of {', '.join(BACKENDS)}.")
+
+    return BACKENDS[backend](model_path, max_batch_size=max_batch_size)
+
+
+def convert_tflite(model_path, output_path, quantization=None, representative_images=None, image_dim=IMAGE_DIM):
+    """
+    Convert the Keras model to TFLite
+    inputs:
+        model_path: path of the Keras model to convert
+        output_path: where to write the .tflite file
+        quantization: None (float32), 'float16' or 'int8'
+        representative_images: directory of sample images used to calibrate int8 quantization
+
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(KerasBackend(model_path).model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == 'int8':
+        if representative_images is None:
+            raise ValueError(
+                "representative_images must be supplied to calibrate int8 quantization.")
+
+        images, _ = load_images(representative_images, (image_dim, image_dim))
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([image[np.newaxis, ...]] for image in images)
+
+    with open(output_path, 'wb') as file:
+        file.write(converter.convert())
+
+
+def warm_up(model, image_dim=IMAGE_DIM):
+    """ Run a throwaway prediction on a dummy tensor so the first real request doesn't pay for graph set-up...."""
+    classify_nd(model, np.zeros((1, image_dim, image_dim, 3), dtype=np.float32))
     return model
 
 
@@ -67,21 +244,47 @@ def classify(model, input_paths, image_dim=IMAGE_DIM):
     return dict(zip(['data'], probs))
 
 
+def classify_bytes(model, image_bytes, image_dim=IMAGE_DIM):
+    """ Classify given a model, raw image bytes, and image dimensionality, without touching the disk...."""
+    image = load_image_bytes(image_bytes, (image_dim, image_dim))
+    probs = classify_nd(model, image[np.newaxis, ...])
+    return dict(zip(['data'], probs))
+
+
+def predict_nd(model, nd_images):
+    """ Score given a model, image array (numpy), as an (n, len(CATEGORIES)) matrix of percentages...."""
+    return np.round(np.asarray(model.predict(nd_images), dtype=np.float64), 6) * 100
+
+
+def to_dicts(percentages):
+    """ Convert rows of a percentage matrix into {category: percentage} dicts, for serialization only...."""
+    return [dict(zip(CATEGORIES, row)) for row in np.asarray(percentages).tolist()]
+
+
 def classify_nd(model, nd_images):
     """ Classify given a model, image array (numpy)...."""
+    return to_dicts(predict_nd(model, nd_images))
 
-    model_preds = model.predict(nd_images)
-    # preds = np.argsort(model_preds, axis = 1).tolist()
 
-    categories = ['drawings', 'hentai', 'neutral', 'porn', 'sexy']
+class NSFWPolicy:
+    """
+    Decides which scored images are NSFW: anything at least `neutral_threshold`% neutral is safe, otherwise it is
+    NSFW once `explicit_categories` add up to `explicit_threshold`%
+
+    """
+
+    def __init__(self, neutral_threshold=45, explicit_threshold=70, explicit_categories=('sexy', 'porn', 'hentai')):
+        self.neutral_threshold = neutral_threshold
+        self.explicit_threshold = explicit_threshold
+        self.neutral_index = CATEGORIES.index('neutral')
+        self.explicit_indexes = [CATEGORIES.index(category) for category in explicit_categories]
 
-    probs = []
-    for i, single_preds in enumerate(model_preds):
-        single_probs = {}
-        for j, pred in enumerate(single_preds):
-            single_probs[categories[j]] = round(float(pred), 6) * 100
-        probs.append(single_probs)
-    return probs
+    def evaluate(self, percentages):
+        """ Vectorized over a whole (n, len(CATEGORIES)) percentage matrix, returns an (n,) boolean array...."""
+        percentages = np.asarray(percentages).reshape(-1, len(CATEGORIES))
+        neutral = percentages[:, self.neutral_index] >= self.neutral_threshold
+        explicit = percentages[:, self.explicit_indexes].sum(axis=1) >= self.explicit_threshold
+        return ~neutral & explicit
 
 
 def main(args=None):
@@ -99,6 +302,8 @@ def main(args=None):
                          help='A directory of nsfw_images or a single image to classify')
     submain.add_argument('--saved_model_path', dest='saved_model_path', type=str, required=True,
                          help='The model to load')
+    submain.add_argument('--backend', dest='backend', type=str, default='keras', choices=list(BACKENDS),
+                         help='The runtime to load the model with')
     submain.add_argument('--image_dim', dest='image_dim', type=int, default=IMAGE_DIM,
                          help="The square dimension of the model's input shape")
     if args is not None:
@@ -110,6 +315,6 @@ def main(args=None):
         raise ValueError(
             "image_source must be a valid directory with nsfw_images or a single image to classify.")
 
-    model = load_model(config['saved_model_path'])
+    model = load_model(config['saved_model_path'], config['backend'])
     image_preds = classify(model, config['image_source'], config['image_dim'])
     print(json.dumps(image_preds, indent=2), '\n')
@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+import logging
+import time
+import traceback
+from typing import Dict, Optional, Any
+
+import aiomysql
+
+from utilities.statistics.statistics_sql import StatisticSQL
+
+
+class WriteBehindBuffer:
+    """
+    Base for in-memory buffers that are flushed to the database every `interval` seconds (and once more on shutdown)
+
+    """
+
+    def __init__(self, sql_pool: aiomysql.Pool, interval: float = 5):
+        self.sql_pool: aiomysql.Pool = sql_pool
+        self.interval: float = interval
+
+        self._lock: asyncio.Lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _swap(self) -> Any:
+        """
+        Take everything currently buffered, leaving the buffer empty
+
+        """
+
+        raise NotImplementedError
+
+    def _restore(self, data: Any) -> None:
+        """
+        Put back data from a failed write so it is retried on the next flush
+
+        """
+
+        raise NotImplementedError
+
+    async def _write(self, data: Any) -> None:
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        async with self._lock:
+            data: Any = self._swap()
+
+            if not data:
+                return
+
+            try:
+                await self._write(data)
+            except Exception:
+                # Keep the data for the next attempt rather than losing it
+                self._restore(data)
+                raise
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        # Graceful shutdown, don't lose anything still buffered
+        try:
+            await self.flush()
+        except Exception:
+            logging.error(f"Lost buffered statistics in {type(self).__name__}\n{traceback.format_exc()}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.flush()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+class TrackingBuffer(WriteBehindBuffer):
+    """
+    Write-behind buffer for the stat_tracking counters
+
+    Increments accumulate per date & field and are flushed as a single statement, instead of one row-locking UPDATE
+    per event.
+
+    """
+
+    def __init__(self, sql_pool: aiomysql.Pool, interval: float = 5):
+        super().__init__(sql_pool, interval)
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def increment(self, field_name: str, date: Optional[str] = None, amount: int = 1) -> None:
+        date = date or datetime.datetime.today().strftime('%Y%m%d')
+        counts: Dict[str, int] = self._counts.setdefault(date, {})
+        counts[field_name] = counts.get(field_name, 0) + amount
+
+    def merge(self, increments: Dict[str, Dict[str, int]]) -> None:
+        for date, counts in increments.items():
+            for field_name, amount in counts.items():
+                self.increment(field_name, date=date, amount=amount)
+
+    def _swap(self) -> Dict[str, Dict[str, int]]:
+        increments, self._counts = self._counts, {}
+        return increments
+
+    def _restore(self, data: Dict[str, Dict[str, int]]) -> None:
+        self.merge(data)
+
+    async def _write(self, data: Dict[str, Dict[str, int]]) -> None:
+        await StatisticSQL(self.sql_pool).increment_tracking(data)
+
+
+class ActivityBuffer(WriteBehindBuffer):
+    """
+    Debounced last-seen timestamps for user_tracking
+
+    Only the newest timestamp per (signature, field) is kept, so a client repeating the same action between flushes
+    costs one row in one batched upsert rather than a write per event.
+
+    """
+
+    def __init__(self, sql_pool: aiomysql.Pool, interval: float = 30):
+        super().__init__(sql_pool, interval)
+        self._timestamps: Dict[str, Dict[str, int]] = {}
+
+    def touch(self, signature: str, field_name: str, timestamp: Optional[int] = None) -> None:
+        timestamp = round(time.time()) if timestamp is None else timestamp
+        fields: Dict[str, int] = self._timestamps.setdefault(signature, {})
+        fields[field_name] = max(fields.get(field_name, timestamp), timestamp)
+
+    def _swap(self) -> Dict[str, Dict[str, int]]:
+        timestamps, self._timestamps = self._timestamps, {}
+        return timestamps
+
+    def _restore(self, data: Dict[str, Dict[str, int]]) -> None:
+        for signature, fields in data.items():
+            for field_name, timestamp in fields.items():
+                self.touch(signature, field_name, timestamp)
+
+    async def _write(self, data: Dict[str, Dict[str, int]]) -> None:
+        await StatisticSQL(self.sql_pool).insert_update_statistics(data)
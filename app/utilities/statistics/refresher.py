@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import traceback
+import uuid
+from typing import Optional
+
+import aiomysql
+import aioredis
+
+from api.statsimage import StatsImageResponse
+from utilities.http import HTTPClient
+from utilities.statistics.statistics import refresh_statistics, refresh_chrome_statistics
+
+
+class StatisticsRefresher:
+    """
+    Periodically rebuilds the statistics snapshot, the web-store statistics & the statistics image so that requests
+    only ever read them from the cache
+
+    Every worker runs one, but only the elected leader (holder of a Redis lease) does any work.
+
+    """
+
+    LEADER_KEY: str = "chromegle:refresher:leader"
+
+    # Only renew/release the lease if we still hold it
+    RENEW_LEASE_SCRIPT: str = (
+        """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('expire', KEYS[1], ARGV[2])
+        end
+        return 0
+        """
+    )
+
+    RELEASE_LEASE_SCRIPT: str = (
+        """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+        """
+    )
+
+    def __init__(self, redis: aioredis.Redis, sql_pool: aiomysql.Pool, http: HTTPClient, interval: float = 60):
+        self.redis: aioredis.Redis = redis
+        self.sql_pool: aiomysql.Pool = sql_pool
+        self.http: HTTPClient = http
+        self.interval: float = interval
+
+        # Outlive a couple of missed renewals before another worker takes over
+        self.lease: int = max(1, round(interval * 3))
+        self.identity: str = uuid.uuid4().hex
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+        self._task = None
+
+        # Hand leadership over straight away instead of waiting for the lease to expire
+        try:
+            await self.redis.eval(self.RELEASE_LEASE_SCRIPT, 1, self.LEADER_KEY, self.identity)
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    async def is_leader(self) -> bool:
+        """
+        Acquire or renew the leader lease
+
+        """
+
+        if await self.redis.set(self.LEADER_KEY, self.identity, nx=True, ex=self.lease):
+            return True
+
+        return bool(await self.redis.eval(self.RENEW_LEASE_SCRIPT, 1, self.LEADER_KEY, self.identity, self.lease))
+
+    async def refresh(self) -> None:
+        stats: Optional[dict] = await refresh_statistics(self.sql_pool, self.redis)
+        await refresh_chrome_statistics(self.redis, self.http)
+
+        # Re-render the image from the snapshot just built
+        if stats is not None:
+            await StatsImageResponse(stats, self.redis).update_image()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self.is_leader():
+                    await self.refresh()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+            await asyncio.sleep(self.interval)
@@ -1,16 +1,41 @@
+import asyncio
 import datetime
 import json
 import logging
-import traceback
-from typing import Optional, List
+from typing import Optional, List, Dict, Set
 
-import aiohttp
 import aiomysql
 import aioredis
 
 import config
+from utilities.cache import SharedCache, CacheEntry
+from utilities.http import HTTPClient
+from utilities.statistics.buffer import TrackingBuffer, ActivityBuffer
 from utilities.statistics.statistics_sql import StatisticSQL
 
+# Refresh every 120s, serving the previous value for up to another 10 minutes while rebuilding
+STATISTICS_CACHE: SharedCache = SharedCache("chromegle:statistics", ttl=120, stale_ttl=600, refresh_ahead=10)
+CHROME_STATISTICS_CACHE: SharedCache = SharedCache("chromegle:chrome:statistics", ttl=120, stale_ttl=600, refresh_ahead=10)
+
+# Where each web-store statistic comes from
+WEB_STATS_SOURCES: Dict[str, str] = {
+    "users": "https://img.shields.io/chrome-web-store/users/gcbbaikjfjmidabapdnebofcmconhdbn.json",
+    "rating": "https://img.shields.io/chrome-web-store/rating/gcbbaikjfjmidabapdnebofcmconhdbn.json",
+    "rating-count": "https://img.shields.io/chrome-web-store/rating-count/gcbbaikjfjmidabapdnebofcmconhdbn.json",
+    "version": "https://img.shields.io/chrome-web-store/v/gcbbaikjfjmidabapdnebofcmconhdbn.json"
+}
+
+# Per-source timeout & fallback values for the web-store statistics
+WEB_STATS_TIMEOUT: float = 5
+WEB_STATS_LAST_KNOWN_GOOD: str = "chromegle:chrome:statistics:last-known-good"
+
+# Chromegler membership, a miss may just be a new user whose row is still in an ActivityBuffer so it's kept only briefly
+USER_EXISTS_EXPIRY: int = 3600
+
+
+def _user_exists_expiry(exists: bool) -> int:
+    return USER_EXISTS_EXPIRY if exists else max(1, int(config.Statistics.ACTIVITY_FLUSH_INTERVAL))
+
 
 async def user_exists(signature: str, sql_pool: aiomysql.Pool, redis: aioredis.Redis, use_redis: bool = True) -> bool:
     existence: Optional[bytes] = None
@@ -21,93 +46,119 @@ async def user_exists(signature: str, sql_pool: aiomysql.Pool, redis: aioredis.R
     # Not cached (refresh every 120s)
     if existence is None:
         existence: int = await _user_exists(signature, sql_pool)
-        await redis.set(f"chromegle:user:{signature}", str(existence), ex=3600)
+        await redis.set(f"chromegle:user:{signature}", str(existence), ex=_user_exists_expiry(bool(existence)))
         return bool(existence)
 
     # Decode & return cached value
     return bool(int(bytes.decode(existence, encoding="utf-8")))
 
 
+async def users_exist(signatures: List[str], sql_pool: aiomysql.Pool, redis: aioredis.Redis) -> Dict[str, bool]:
+    """
+    Check Chromegler membership for many hashed addresses with one Redis MGET & at most one query for the misses
+
+    """
+
+    signatures = list(dict.fromkeys(signatures))
+
+    if not signatures:
+        return {}
+
+    cached: List[Optional[bytes]] = await redis.mget(*(f"chromegle:user:{signature}" for signature in signatures))
+    existence: Dict[str, bool] = {
+        signature: bool(int(value.decode("utf-8")))
+        for signature, value in zip(signatures, cached) if value is not None
+    }
+
+    missing: List[str] = [signature for signature in signatures if signature not in existence]
+
+    if missing:
+        found: Set[str] = await StatisticSQL(sql_pool).chromegle_users_exist(missing)
+
+        async with redis.pipeline(transaction=False) as pipe:
+            for signature in missing:
+                existence[signature] = signature in found
+                pipe.set(f"chromegle:user:{signature}", str(int(existence[signature])), ex=_user_exists_expiry(existence[signature]))
+
+            await pipe.execute()
+
+    return existence
+
+
 async def _user_exists(signature: str, sql_pool: aiomysql.Pool) -> int:
     sql: StatisticSQL = StatisticSQL(sql_pool)
     return await sql.chromegle_user_exists(signature)
 
 
 async def get_statistics(sql_pool: aiomysql.Pool, redis: aioredis.Redis, use_redis: bool = True):
-    stats: Optional[bytes] = None
+    if not use_redis:
+        return await _retrieve_statistics(sql_pool)
 
-    if use_redis:
-        stats = await redis.get("chromegle:statistics")
+    return await STATISTICS_CACHE.get(redis, lambda: _retrieve_statistics(sql_pool))
 
-    # Not cached (refresh every 120s)
-    if stats is None:
-        stats: dict = await _retrieve_statistics(sql_pool)
-        await redis.set("chromegle:statistics", json.dumps(stats), ex=120)
-        return stats
 
-    stats: dict = json.loads(bytes.decode(stats, encoding="utf-8"))
-    return stats
+async def get_chrome_statistics(redis: aioredis.Redis, http: HTTPClient, use_redis: bool = True):
+    if not use_redis:
+        return await _retrieve_web_stats(http, redis)
 
+    return await CHROME_STATISTICS_CACHE.get(redis, lambda: _retrieve_web_stats(http, redis))
 
-async def get_chrome_statistics(redis: aioredis.Redis, use_redis: bool = True):
-    stats: Optional[bytes] = None
 
-    if use_redis:
-        stats = await redis.get("chromegle:chrome:statistics")
+async def get_statistics_entry(sql_pool: aiomysql.Pool, redis: aioredis.Redis) -> CacheEntry:
+    return await STATISTICS_CACHE.get_entry(redis, lambda: _retrieve_statistics(sql_pool))
 
-    # Not cached (refresh every 120s)
-    if stats is None:
-        stats: dict = await _retrieve_web_stats()
-        await redis.set("chromegle:chrome:statistics", json.dumps(stats), ex=120)
-        return stats
 
-    stats: dict = json.loads(bytes.decode(stats, encoding="utf-8"))
-    return stats
+async def get_chrome_statistics_entry(redis: aioredis.Redis, http: HTTPClient) -> CacheEntry:
+    return await CHROME_STATISTICS_CACHE.get_entry(redis, lambda: _retrieve_web_stats(http, redis))
 
 
-async def _retrieve_web_stats():
+async def refresh_statistics(sql_pool: aiomysql.Pool, redis: aioredis.Redis) -> Optional[dict]:
     """
-    https://img.shields.io/chrome-web-store/users/gcbbaikjfjmidabapdnebofcmconhdbn.json
-    https://img.shields.io/chrome-web-store/rating/gcbbaikjfjmidabapdnebofcmconhdbn.json
-    https://img.shields.io/chrome-web-store/rating-count/gcbbaikjfjmidabapdnebofcmconhdbn.json
-    https://img.shields.io/chrome-web-store/v/gcbbaikjfjmidabapdnebofcmconhdbn.json
+    Rebuild the cached statistics now
+
+    :return: The new statistics, or None if another worker is already rebuilding them
+
     """
 
-    stats: dict = {
-        "users": {
-            "source": "https://img.shields.io/chrome-web-store/users/gcbbaikjfjmidabapdnebofcmconhdbn.json",
-            "value": None
-        },
-        "rating": {
-            "source": "https://img.shields.io/chrome-web-store/rating/gcbbaikjfjmidabapdnebofcmconhdbn.json",
-            "value": None
-        },
-        "rating-count": {
-            "source": "https://img.shields.io/chrome-web-store/rating-count/gcbbaikjfjmidabapdnebofcmconhdbn.json",
-            "value": None
-        },
-        "version": {
-            "source": "https://img.shields.io/chrome-web-store/v/gcbbaikjfjmidabapdnebofcmconhdbn.json",
-            "value": None
-        }
-    }
+    stats: Optional[bytes] = await STATISTICS_CACHE.refresh(redis, lambda: _retrieve_statistics(sql_pool))
+    return None if stats is None else json.loads(stats.decode("utf-8"))
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(stats["users"]["source"]) as request:
-                stats["users"]["value"] = (await request.json())["value"]
 
-            async with session.get(stats["rating"]["source"]) as request:
-                stats["rating"]["value"] = (await request.json())["value"]
+async def refresh_chrome_statistics(redis: aioredis.Redis, http: HTTPClient) -> None:
+    await CHROME_STATISTICS_CACHE.refresh(redis, lambda: _retrieve_web_stats(http, redis))
 
-            async with session.get(stats["rating-count"]["source"]) as request:
-                stats["rating-count"]["value"] = (await request.json())["value"]
 
-            async with session.get(stats["version"]["source"]) as request:
-                stats["version"]["value"] = (await request.json())["value"]
+async def _retrieve_web_stats(http: HTTPClient, redis: aioredis.Redis):
+    """
+    Fetched concurrently from WEB_STATS_SOURCES, any source that fails falls back to its last-known-good value
+    """
+
+    stats: dict = {name: {"source": source, "value": None} for name, source in WEB_STATS_SOURCES.items()}
+
+    async def fetch(source: str):
+        return (await http.get_json(source, timeout=WEB_STATS_TIMEOUT, retries=0))["value"]
+
+    values: list = await asyncio.gather(*[fetch(stat["source"]) for stat in stats.values()], return_exceptions=True)
+    fresh: Dict[str, str] = {}
+
+    for name, value in zip(stats, values):
+        if isinstance(value, BaseException):
+            logging.error(f"Failed to retrieve web-store {name} from {stats[name]['source']}: {value!r}")
+            continue
+
+        stats[name]["value"] = value
+        fresh[name] = json.dumps(value)
 
-    except:
-        logging.error(traceback.format_exc())
+    # Remember what worked, fill in what didn't
+    if fresh:
+        await redis.hset(WEB_STATS_LAST_KNOWN_GOOD, mapping=fresh)
+
+    if len(fresh) < len(stats):
+        last_known_good: Dict[bytes, bytes] = await redis.hgetall(WEB_STATS_LAST_KNOWN_GOOD)
+
+        for name in stats:
+            if name not in fresh and name.encode("utf-8") in last_known_good:
+                stats[name]["value"] = json.loads(last_known_good[name.encode("utf-8")].decode("utf-8"))
 
     return stats
 
@@ -115,65 +166,78 @@ async def _retrieve_web_stats():
 async def _retrieve_statistics(sql_pool: aiomysql.Pool):
     _today = datetime.datetime.today().strftime('%Y%m%d')
     _week_ago = (datetime.datetime.today() - datetime.timedelta(days=7)).strftime('%Y%m%d')
-    sql: StatisticSQL = StatisticSQL(sql_pool)
+    fields = config.Statistics.OMEGLE_OPEN_FIELD, config.Statistics.CHAT_END_FIELD, config.Statistics.CHAT_START_FIELD
 
-    # Recent Statistics
-    rec_open_entries = await sql.get_recent_activity(config.Statistics.OMEGLE_OPEN_FIELD, 10)
-    rec_end_entries = await sql.get_recent_activity(config.Statistics.CHAT_END_FIELD, 10)
-    rec_start_entries = await sql.get_recent_activity(config.Statistics.CHAT_START_FIELD, 10)
+    # Separate StatisticSQL instances, each holds its own connection while running
+    recent, snapshot = await asyncio.gather(
+        # Recent Statistics (online, omegle_opened, chat_ended, chat_started)
+        StatisticSQL(sql_pool).get_recent_activity_counts(*fields, within_minutes=10),
 
-    # Since 12:00AM
-    today = await sql.get_tracking_count_between_dates(
-        config.Statistics.OMEGLE_OPEN_FIELD, config.Statistics.CHAT_START_FIELD, config.Statistics.CHAT_END_FIELD, start=_today, end=_today,
+        # Since 12:00AM, within 1 week of 12:00AM & all-time (each omegle_opened, chat_ended, chat_started)
+        StatisticSQL(sql_pool).get_tracking_snapshot(*fields, today=_today, week_ago=_week_ago)
     )
 
-    # Within 1 Week of 12:00
-    week = await sql.get_tracking_count_between_dates(
-        config.Statistics.OMEGLE_OPEN_FIELD, config.Statistics.CHAT_START_FIELD, config.Statistics.CHAT_END_FIELD, start=_week_ago, end=_today,
-    )
-
-    # All-Time Statistics (chat_started, chat_ended, omegle_opened)
-    all_time = await sql.get_tracking_count(config.Statistics.OMEGLE_OPEN_FIELD, config.Statistics.CHAT_START_FIELD, config.Statistics.CHAT_END_FIELD)
+    today, week, all_time = snapshot[0:3], snapshot[3:6], snapshot[6:9]
 
     return {
-        "online_users": len(set(rec_open_entries + rec_end_entries + rec_start_entries)),
-        "ten_minutes": {"chats_started": len(rec_start_entries), "chats_ended": len(rec_end_entries), "times_opened": len(rec_open_entries)},
+        "online_users": recent[0],
+        "ten_minutes": {"chats_started": recent[3], "chats_ended": recent[2], "times_opened": recent[1]},
         "today": {"times_opened": today[0], "chats_started": today[2], "chats_ended": today[1]},
         "week": {"times_opened": week[0], "chats_started": week[2], "chats_ended": week[1]},
         "forever": {"times_opened": all_time[0], "chats_started": all_time[2], "chats_ended": all_time[1]}
     }
 
 
-async def log_statistics(signature: str, action: str, sql_pool: aiomysql.Pool, timestamp: Optional[int] = None) -> bool:
-    """
-    Log statistics
-
-    """
-
-    field_name: str = {
+def _action_field(action: str) -> Optional[str]:
+    return {
         "chatStarted": config.Statistics.CHAT_START_FIELD,
         "chatEnded": config.Statistics.CHAT_END_FIELD,
         "omegleOpened": config.Statistics.OMEGLE_OPEN_FIELD
     }.get(action)
 
+
+async def log_statistics(
+        signature: str, action: str, tracking: TrackingBuffer, activity: ActivityBuffer, timestamp: Optional[int] = None
+) -> bool:
+    """
+    Log statistics (both the user_tracking timestamp & stat_tracking counter are buffered & written behind)
+
+    """
+
+    field_name: Optional[str] = _action_field(action)
+
     # Invalid action
     if not field_name:
         return False
 
-    sql: StatisticSQL = StatisticSQL(sql_pool)
+    activity.touch(signature, field_name, timestamp)
+    tracking.increment(field_name)
 
-    await sql.insert_update_statistic(signature=signature, field_name=field_name, timestamp=timestamp)
-    await sql.insert_update_tracking(stat_name=field_name)
+    return True
 
 
-async def log_statistics_bulk(signature: str, actions: List[list], sql_pool: aiomysql.Pool) -> bool:
+async def log_statistics_bulk(signature: str, actions: List[list], tracking: TrackingBuffer, activity: ActivityBuffer) -> bool:
     """
-    Log statistics
+    Log statistics, collapsed into the latest timestamp per user_tracking field and one stat_tracking increment per
+    date & field before being buffered
 
     """
     time: int = round(datetime.datetime.now().timestamp())
+    increments: Dict[str, Dict[str, int]] = {}
 
     for action, timestamp in actions:
-        await log_statistics(signature=signature, action=action, sql_pool=sql_pool, timestamp=max(min(time + 10, timestamp), time - 3600))
+        field_name: Optional[str] = _action_field(action)
+
+        # Invalid action
+        if not field_name:
+            continue
+
+        timestamp: int = max(min(time + 10, timestamp), time - 3600)
+        date: str = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
+
+        activity.touch(signature, field_name, timestamp)
+        counts: Dict[str, int] = increments.setdefault(date, {})
+        counts[field_name] = counts.get(field_name, 0) + 1
 
+    tracking.merge(increments)
     return True
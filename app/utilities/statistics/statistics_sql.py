@@ -1,5 +1,7 @@
 import datetime
-from typing import Optional, List
+import logging
+import time
+from typing import Optional, List, Dict, Tuple, Set, FrozenSet, Any, Iterable, Sequence
 
 from aiomysql import Connection, Cursor, Pool
 
@@ -8,12 +10,18 @@ from models.mysql import SQLEntryPoint, StatementEnum
 
 # noinspection SqlNoDataSourceInspection
 class StatisticStatements(StatementEnum):
+    """
+    Fixed statement shapes, values are always bound by the driver ({} slots only ever take whitelisted column names or
+    placeholder lists)
+
+    """
+
     CHROMEGLE_USER_EXISTS: str = (
         """
         SELECT
         CASE WHEN EXISTS 
         (
-            SELECT * FROM user_tracking WHERE address='%s'
+            SELECT * FROM user_tracking WHERE address=%s
         )
         THEN 1
         ELSE 0
@@ -21,98 +29,249 @@ class StatisticStatements(StatementEnum):
         """
     )
 
-    INSERT_UPDATE_STATISTIC: str = (
+    CHROMEGLE_USERS_EXIST: str = (
         """
-        INSERT INTO user_tracking (address) 
-        VALUES('%s') 
-        ON DUPLICATE KEY 
-        UPDATE %s=%s
+        SELECT LOWER(HEX(address)) FROM user_tracking WHERE address IN ({placeholders})
         """
     )
 
-    INSERT_UPDATE_TRACKING: str = (
+    INSERT_UPDATE_STATISTICS: str = (
         """
-        INSERT INTO stat_tracking (date, chat_started, chat_ended, omegle_opened) 
-        VALUES(%s, 0, 0, 0) 
+        INSERT INTO user_tracking (address, {fields}) 
+        VALUES ({placeholders}) 
         ON DUPLICATE KEY 
-        UPDATE %s=%s+1
+        UPDATE {updates}
         """
     )
 
-    GET_RECENT_STAT: str = (
+    INCREMENT_TRACKING: str = (
         """
-        SELECT address
-        FROM user_tracking
-        WHERE %s >= TIMESTAMP(date_sub(UTC_TIMESTAMP(), INTERVAL %s MINUTE))
+        INSERT INTO stat_tracking (date, chat_started, chat_ended, omegle_opened) 
+        VALUES (%s, %s, %s, %s) 
+        ON DUPLICATE KEY 
+        UPDATE 
+            chat_started=COALESCE(chat_started, 0)+VALUES(chat_started), 
+            chat_ended=COALESCE(chat_ended, 0)+VALUES(chat_ended), 
+            omegle_opened=COALESCE(omegle_opened, 0)+VALUES(omegle_opened)
         """
     )
 
-    GET_ALL_TIME_COUNT: str = (
+    INCREMENT_TOTALS: str = (
         """
-        SELECT %s
-        FROM stat_tracking
+        INSERT INTO stat_totals (id, chat_started, chat_ended, omegle_opened) 
+        VALUES(1, %s, %s, %s) 
+        ON DUPLICATE KEY 
+        UPDATE 
+            chat_started=chat_started+VALUES(chat_started), 
+            chat_ended=chat_ended+VALUES(chat_ended), 
+            omegle_opened=omegle_opened+VALUES(omegle_opened)
         """
     )
 
-    GET_DATE_STAT: str = (
+    GET_RECENT_COUNTS: str = (
         """
-        SELECT %s FROM stat_tracking WHERE date=%s
+        SELECT COUNT(*), {counts}
+        FROM user_tracking, (SELECT TIMESTAMP(date_sub(UTC_TIMESTAMP(), INTERVAL %s MINUTE)) AS since) AS recent
+        WHERE {any_recent}
         """
     )
 
-    GET_BETWEEN_DATE_STAT: str = (
+    GET_SNAPSHOT: str = (
         """
-        SELECT %s FROM stat_tracking WHERE date BETWEEN %s AND %s
+        SELECT {columns}
+        FROM stat_tracking
+        WHERE date BETWEEN %s AND %s
         """
-
     )
 
-    CLEAR_TABLE: str = (
-        """
-        DELETE FROM %s
-        """
-    )
+
+class StatementTiming:
+    """
+    Running totals of how long one statement takes to execute
+
+    """
+
+    __slots__ = ("count", "total", "slowest")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0
+        self.slowest: float = 0
+
+    def record(self, elapsed: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        self.slowest = max(self.slowest, elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count else 0,
+            "max_ms": round(self.slowest * 1000, 3)
+        }
 
 
 class StatisticSQL:
+    MAX_ROWS_PER_STATEMENT: int = 1000
+
+    # The only names that may fill a column slot
+    STAT_COLUMNS: FrozenSet[str] = frozenset({"chat_started", "chat_ended", "omegle_opened"})
+
+    # Per-statement execution times for this worker, statements slower than SLOW_STATEMENT seconds are logged
+    TIMINGS: Dict[str, StatementTiming] = {}
+    SLOW_STATEMENT: float = 1
 
     def __init__(self, pool: Pool):
         self.pool: Pool = pool
         self.connection: Optional[Connection] = None
         self.cursor: Optional[Cursor] = None
 
-    @SQLEntryPoint
-    async def get_recent_activity(self, field_name: str, within_minutes: int):
+    @classmethod
+    def timings(cls) -> Dict[str, Dict[str, Any]]:
+        return {name: timing.stats() for name, timing in cls.TIMINGS.items()}
+
+    @classmethod
+    def log_timings(cls) -> None:
+        for name, stats in cls.timings().items():
+            logging.info(f"Statistics statement {name}: {stats}")
+
+    @classmethod
+    def _columns(cls, names: Iterable[str], allowed: FrozenSet[str]) -> List[str]:
+        names = list(names)
+        unknown: Set[str] = set(names) - allowed
+
+        if unknown:
+            raise ValueError(f"Unknown column(s) {', '.join(sorted(unknown))}")
+
+        return names
+
+    @staticmethod
+    def _address(signature: str) -> bytes:
+        # Hex SHA-1 signature to the BINARY(20) stored in user_tracking
+        return bytes.fromhex(signature)
+
+    async def _execute(self, statement: StatisticStatements, query: str, args: Optional[Sequence] = None, many: bool = False) -> None:
         """
-        Get a statistic from one of the timestamp tables
+        Execute one of the catalogued statements, recording how long it took
+
+        :param many: Run once per row of args (batched into multi-row INSERTs by the driver)
+
         """
-        await self.cursor.execute(StatisticStatements.GET_RECENT_STAT % (field_name, min(within_minutes, within_minutes)))
-        return await self.cursor.fetchall()
+
+        started: float = time.perf_counter()
+
+        if many:
+            await self.cursor.executemany(query, args)
+        else:
+            await self.cursor.execute(query, args)
+
+        elapsed: float = time.perf_counter() - started
+        self.TIMINGS.setdefault(statement.name, StatementTiming()).record(elapsed)
+
+        if elapsed >= self.SLOW_STATEMENT:
+            logging.warning(f"Slow statistics statement {statement.name} took {elapsed * 1000:.1f}ms")
 
     @SQLEntryPoint
-    async def get_tracking_count(self, *stat_name):
-        built: List[str] = [f"CAST(SUM({stat}) AS SIGNED)" for stat in stat_name]
-        await self.cursor.execute(StatisticStatements.GET_ALL_TIME_COUNT % ','.join(built))
+    async def get_recent_activity_counts(self, *field_name: str, within_minutes: int):
+        """
+        Count recent activity server-side in a single pass, without shipping any addresses back
+
+        :return: Distinct users active in any of the fields, followed by the number active in each field (in order)
+
+        """
+
+        fields: List[str] = self._columns(field_name, self.STAT_COLUMNS)
+
+        # One row per address, so counting the rows active in any field counts distinct users
+        await self._execute(
+            StatisticStatements.GET_RECENT_COUNTS,
+            StatisticStatements.GET_RECENT_COUNTS.format(
+                counts=', '.join(f"CAST(COALESCE(SUM({field} >= recent.since), 0) AS SIGNED)" for field in fields),
+                any_recent=' OR '.join(f"{field} >= recent.since" for field in fields)
+            ),
+            [int(within_minutes)]
+        )
+
         return await self.cursor.fetchone()
 
     @SQLEntryPoint
-    async def get_tracking_count_between_dates(self, *stat_name, start: str, end: str):
-        built: List[str] = [f"CAST(SUM({stat}) AS SIGNED)" for stat in stat_name]
-        await self.cursor.execute(StatisticStatements.GET_BETWEEN_DATE_STAT % (','.join(built), start, end))
+    async def get_tracking_snapshot(self, *stat_name: str, today: str, week_ago: str):
+        """
+        Get today's, the past week's & all-time totals in a single scan of the past week of stat_tracking
+
+        :return: Each stat for today, then each stat for the week, then each all-time total (in the order given)
+
+        """
+
+        stats: List[str] = self._columns(stat_name, self.STAT_COLUMNS)
+        built: List[str] = (
+                [f"CAST(SUM(CASE WHEN date=%s THEN {stat} ELSE 0 END) AS SIGNED)" for stat in stats]
+                + [f"CAST(SUM({stat}) AS SIGNED)" for stat in stats]
+                + [f"(SELECT {stat} FROM stat_totals WHERE id=1)" for stat in stats]
+        )
+
+        await self._execute(
+            StatisticStatements.GET_SNAPSHOT,
+            StatisticStatements.GET_SNAPSHOT.format(columns=', '.join(built)),
+            [int(today)] * len(stats) + [int(week_ago), int(today)]
+        )
+
         return await self.cursor.fetchone()
 
     @SQLEntryPoint
-    async def insert_update_statistic(self, signature: str, field_name: str, timestamp: Optional[int] = None):
+    async def insert_update_statistics(self, timestamps: Dict[str, Dict[str, int]]):
+        """
+        Insert statistics for many users into the database in a single transaction, one batched statement per set of
+        fields
+
+        :param timestamps: Latest timestamp for each user_tracking field, per hashed address
+
+        """
+
+        groups: Dict[Tuple[str, ...], List[str]] = {}
+
+        for signature, fields in timestamps.items():
+            groups.setdefault(tuple(sorted(fields)), []).append(signature)
+
+        for fields, signatures in groups.items():
+            columns: List[str] = self._columns(fields, self.STAT_COLUMNS)
+
+            await self._execute(
+                StatisticStatements.INSERT_UPDATE_STATISTICS,
+                StatisticStatements.INSERT_UPDATE_STATISTICS.format(
+                    fields=', '.join(columns),
+                    placeholders=', '.join(['%s'] * (len(columns) + 1)),
+                    updates=', '.join(f"{column}=GREATEST({column}, VALUES({column}))" for column in columns)
+                ),
+                [
+                    [self._address(signature)] + [datetime.datetime.utcfromtimestamp(timestamps[signature][field]) for field in fields]
+                    for signature in signatures
+                ],
+                many=True
+            )
+
+    @SQLEntryPoint
+    async def increment_tracking(self, increments: Dict[str, Dict[str, int]]):
         """
-        Insert a statistic into the database
+        Add to the stat_tracking counters (and the stat_totals all-time totals) in a single transaction
+
+        :param increments: Amount to add to each stat_tracking field, per date (YYYYMMDD)
 
         """
 
-        await self.cursor.execute(StatisticStatements.INSERT_UPDATE_STATISTIC % (
-            signature,
-            field_name,
-            "UTC_TIMESTAMP()" if timestamp is None else "'" + datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") + "'"
-        ))
+        rows: List[list] = [
+            [int(date), counts.get("chat_started", 0), counts.get("chat_ended", 0), counts.get("omegle_opened", 0)]
+            for date, counts in increments.items()
+        ]
+
+        await self._execute(StatisticStatements.INCREMENT_TRACKING, str(StatisticStatements.INCREMENT_TRACKING), rows, many=True)
+
+        # Keep the all-time totals in step, in the same transaction
+        await self._execute(
+            StatisticStatements.INCREMENT_TOTALS, str(StatisticStatements.INCREMENT_TOTALS),
+            [sum(row[i] for row in rows) for i in range(1, 4)]
+        )
 
     @SQLEntryPoint
     async def chromegle_user_exists(self, signature: str) -> int:
@@ -121,16 +280,32 @@ class StatisticSQL:
 
         """
 
-        await self.cursor.execute(StatisticStatements.CHROMEGLE_USER_EXISTS % signature)
+        await self._execute(
+            StatisticStatements.CHROMEGLE_USER_EXISTS, str(StatisticStatements.CHROMEGLE_USER_EXISTS), [self._address(signature)]
+        )
+
         return (await self.cursor.fetchone())[0]
 
     @SQLEntryPoint
-    async def insert_update_tracking(self, stat_name: str):
-        time: str = datetime.datetime.today().strftime('%Y%m%d')
-        c = (StatisticStatements.INSERT_UPDATE_TRACKING % (
-            time,
-            stat_name,
-            stat_name
-        ))
-
-        await self.cursor.execute(c)
+    async def chromegle_users_exist(self, signatures: List[str]) -> Set[str]:
+        """
+        Check which of many users are saved in chromegle
+
+        :return: The subset of signatures that exist
+
+        """
+
+        found: Set[str] = set()
+
+        for i in range(0, len(signatures), self.MAX_ROWS_PER_STATEMENT):
+            chunk: List[str] = signatures[i:i + self.MAX_ROWS_PER_STATEMENT]
+
+            await self._execute(
+                StatisticStatements.CHROMEGLE_USERS_EXIST,
+                StatisticStatements.CHROMEGLE_USERS_EXIST.format(placeholders=', '.join(['%s'] * len(chunk))),
+                [self._address(signature) for signature in chunk]
+            )
+
+            found.update(row[0] for row in await self.cursor.fetchall())
+
+        return found